@@ -0,0 +1,297 @@
+"""Microbenchmarks of the catalog hot path at several catalog sizes, with a baseline to catch regressions.
+
+The sheet rows are cleaned once per sheet change by CatalogSync.rebuild (clean_row + CatalogSnapshot.from_records);
+what runs per click are the snapshot lookups and renders below. For every --rows x --price-cols synthetic catalog (benchmarks/synthetic.py) the suite times:
+  - rebuild / rebuild_1pct: a sheet sync from scratch and after 1% of the rows changed (the row cache reuses the rest)
+  - get_list_of_tools, render_tools_message, get_tool_info, render_models_message, render_price_message
+  - prices, tool_details: the helpers of the handlers, prices answered from the RenderCache as in the bot
+  - order_pricing: calculate_rental_price + render_order_summary of the order confirmation
+Time is the best of --repeat runs per call; a second run under tracemalloc gives the memory one call keeps
+(net) and its peak. --save writes the results as json, --compare checks them against such a file and exits
+with 1 when a benchmark got slower or hungrier than --tolerance allows. Times are compared after dividing by the
+median slowdown of all the benchmarks, so a machine that is faster or slower today (cpu frequency, noisy
+neighbours) does not show up as a change of the code, a regression is a benchmark that got slower than the others;
+differences under a microsecond or 4 KB are noise, not regressions.
+
+    python benchmarks/catalog_suite.py --rows 100 10000 1000000 --price-cols 3 8 --save catalog_baseline.json
+    python benchmarks/catalog_suite.py --rows 100 10000 1000000 --price-cols 3 8 --compare catalog_baseline.json
+"""
+import argparse
+import gc
+import itertools
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from catalog_sync import CatalogSync
+from render_cache import RenderCache
+from session import get_session
+import main as bot
+from synthetic import make_values
+
+
+#the lookups go through this many different tools and models, like different users do; every timed run goes
+#through all of them (see cycling), so it is also the least number of calls of a run
+KEYS = 100
+#memory differences below this are allocator noise, not a regression
+MIN_BYTES = 4096
+#same for time: the sub-microsecond lookups vary by up to 2x between runs on a shared machine, while what the gate is
+#for (a scan of the rows sneaking back into a click handler) costs tens of microseconds already at 100 rows
+MIN_SECONDS = 1e-6
+
+
+
+def run_sync(coroutine):
+    """Result of a coroutine that never suspends (the helpers of the handlers), without an event loop."""
+    try:
+        coroutine.send(None)
+    except StopIteration as e:
+        return e.value
+    raise RuntimeError('The coroutine suspended')
+
+
+def changed_rows(values: list, share: float, seed: int) -> list:
+    """Copy of the sheet values with the first price of share of the rows changed."""
+    rnd = random.Random(seed)
+    changed = list(values)
+    for i in rnd.sample(range(1, len(values)), max(1, int((len(values) - 1) * share))):
+        row = list(changed[i])
+        row[3] = str(int(row[3]) + 1)
+        changed[i] = row
+    return changed
+
+
+def cycling(fn, keys: list):
+    """A function calling fn with the next of keys every time. Its period makes the timer run whole rounds over the
+    keys, so every timed run costs the same mix of cheap and expensive keys instead of a different slice of them."""
+    cycle = itertools.cycle(keys)
+    call = lambda: fn(next(cycle))
+    call.period = len(keys)
+    return call
+
+
+def make_benchmarks(values: list, seed: int) -> dict:
+    """name -> factory returning the function to time; every factory builds its own state so it can be freed after."""
+    catalog_sync = CatalogSync(None)
+    catalog = catalog_sync.rebuild(values, 'bench')
+
+    rnd = random.Random(seed)
+    tools = [rnd.choice(list(catalog.tool_dict.values())) for _ in range(KEYS)]
+    models = [rnd.choice(catalog.get_models(tool)) for tool in tools if catalog.get_models(tool)]
+    has_tiers = len(catalog.price_labels) >= 3 #calculate_rental_price looks up the 1, 3 and 7 day prices
+
+    def lookups(fn, keys):
+        return lambda: cycling(fn, keys)
+
+    def rebuild():
+        return lambda: CatalogSync(None).rebuild(values, 'bench')
+
+    def rebuild_1pct():
+        warm = CatalogSync(None)
+        warm.rebuild(values, 'a')
+        return cycling(lambda version: warm.rebuild(*version), [(changed_rows(values, 0.01, seed), 'b'), (values, 'a')])
+
+    def handler(fn):
+        def factory():
+            context = SimpleNamespace(bot_data={'catalog': catalog, 'render_cache': RenderCache()}, user_data={})
+            session = get_session(context.user_data)
+
+            def call(model):
+                session.model_key = model
+                return run_sync(fn(None, context))
+            return cycling(call, models)
+        return factory
+
+    def order_pricing():
+        orders = [(catalog.get_record(model), rnd.randint(1, 7), rnd.random() < 0.3) for model in models]
+
+        def call(order):
+            record, days, pick_up = order
+            total = bot.calculate_rental_price(record, days)
+            if pick_up:
+                return bot.render_order_summary(record.model_index, total, 'pick_up')
+            return bot.render_order_summary(record.model_index, total, 'Есенина, 20, 29', delivery_fee=512.0)
+        return cycling(call, orders)
+
+    benchmarks = {
+        'rebuild': rebuild,
+        'rebuild_1pct': rebuild_1pct,
+        'get_list_of_tools': lambda: lambda: bot.get_list_of_tools(catalog),
+        'render_tools_message': lambda: lambda: bot.render_tools_message(catalog),
+        'get_tool_info': lookups(lambda tool: list(bot.get_tool_info(catalog, tool)), tools),
+        'render_models_message': lookups(lambda tool: bot.render_models_message(catalog, tool), tools),
+        'render_price_message': lookups(lambda model: bot.render_price_message(catalog, model), models),
+        'prices': handler(bot.prices),
+        'tool_details': handler(bot.tool_details),
+    }
+    if has_tiers:
+        benchmarks['order_pricing'] = order_pricing
+
+    return benchmarks
+
+
+def time_per_call(fn, repeat: int, min_time: float) -> float:
+    for _ in range(getattr(fn, 'period', 1)): #warm up (imports, caches), a whole round so the runs start where it did
+        fn()
+    gc.collect()
+    gc.disable() #like timeit, a collection triggered by an earlier benchmark's garbage is not this one's cost
+    try:
+        return _best_time(fn, repeat, min_time)
+    finally:
+        gc.enable()
+
+
+def _best_time(fn, repeat: int, min_time: float) -> float:
+    calls = getattr(fn, 'period', 1) #multiplied by 10 or 2 below, so always whole rounds of a cycling function
+    while True: #enough calls per run for the timer resolution
+        started = time.perf_counter()
+        for _ in range(calls):
+            fn()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            break
+        calls = calls * 10 if elapsed < min_time / 10 else calls * 2
+
+    best = elapsed / calls
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+        for _ in range(calls):
+            fn()
+        best = min(best, (time.perf_counter() - started) / calls)
+    return best
+
+
+def memory_per_call(fn) -> tuple:
+    """(bytes kept, peak bytes) of one call, the result included."""
+    fn()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        result = fn()
+        after, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return after - before, peak - before
+
+
+def run_suite(rows_list, price_cols_list, repeat, min_time, seed) -> dict:
+    results = {}
+    print(f'{"benchmark":>36} {"per call":>12} {"kept":>10} {"peak":>10}')
+    for rows, price_cols in itertools.product(rows_list, price_cols_list):
+        values = make_values(rows, price_cols=price_cols, seed=seed)
+        benchmarks = make_benchmarks(values, seed)
+        for name, factory in benchmarks.items():
+            key = f'{rows}x{price_cols}/{name}'
+            fn = factory()
+            per_call = time_per_call(fn, repeat, min_time)
+            kept, peak = memory_per_call(fn)
+            del fn
+            gc.collect()
+
+            results[key] = {'seconds': per_call, 'kept_bytes': kept, 'peak_bytes': peak}
+            print(f'{key:>36} {format_seconds(per_call):>12} {format_bytes(kept):>10} {format_bytes(peak):>10}')
+
+        del values, benchmarks
+        gc.collect()
+
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float, speed: float = 1.0) -> list:
+    """Prints current vs baseline, returns the keys that regressed (slower or more memory beyond tolerance, and by
+    more than MIN_SECONDS / MIN_BYTES).
+
+    speed: how much slower the machine is now than when the baseline was saved (machine_speed), times are divided by it.
+    """
+    regressions = []
+    print(f'\n{"benchmark":>36} {"time":>8} {"peak":>8}')
+    for key, current in results.items():
+        old = baseline.get(key)
+        if old is None:
+            print(f'{key:>36} {"new":>8}')
+            continue
+
+        expected = old['seconds'] * speed
+        time_ratio = current['seconds'] / expected if expected else 1.0
+        slower = current['seconds'] - expected > max(MIN_SECONDS, tolerance * expected)
+        peak_grew = current['peak_bytes'] - old['peak_bytes'] > max(MIN_BYTES, tolerance * old['peak_bytes'])
+        regressed = slower or peak_grew
+        peak_ratio = current['peak_bytes'] / old['peak_bytes'] if old['peak_bytes'] else 1.0
+        print(f'{key:>36} {time_ratio:>7.2f}x {peak_ratio:>7.2f}x{"  REGRESSION" if regressed else ""}')
+        if regressed:
+            regressions.append(key)
+
+    return regressions
+
+
+def machine_speed(results: dict, baseline: dict) -> float:
+    """Median of the current / baseline times of the benchmarks in both. A separate reference workload does not
+    track a shared machine: its noise comes and goes during the run and hits some benchmarks more than others."""
+    ratios = [current['seconds'] / baseline[key]['seconds'] for key, current in results.items()
+              if key in baseline and baseline[key]['seconds']]
+    return statistics.median(ratios) if ratios else 1.0
+
+
+def format_seconds(seconds: float) -> str:
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return f'{seconds / scale:.2f} {unit}'
+    return f'{seconds / 1e-9:.0f} ns'
+
+
+def format_bytes(size: int) -> str:
+    for unit, scale in (('MB', 2 ** 20), ('KB', 2 ** 10)):
+        if abs(size) >= scale:
+            return f'{size / scale:.1f} {unit}'
+    return f'{size} B'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Catalog hot path microbenchmarks')
+    parser.add_argument('--rows', type=int, nargs='+', default=[100, 10000, 1000000])
+    parser.add_argument('--price-cols', type=int, nargs='+', default=[3], help='price columns of the synthetic sheet (up to 8)')
+    #many short runs: the best of them more likely falls in a quiet moment of a shared machine than the best of a few long ones
+    parser.add_argument('--repeat', type=int, default=25)
+    parser.add_argument('--min-time', type=float, default=0.04, help='seconds every timed run lasts at least')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', metavar='PATH', help='write the results to this json baseline')
+    parser.add_argument('--compare', metavar='PATH', help='compare with a baseline written by --save, exit 1 on regressions')
+    #shared cloud machines vary by up to half from run to run even for the same benchmark, what this is for (a scan
+    #of the rows sneaking back into a click handler) is a many times slowdown at 10k rows and more
+    parser.add_argument('--tolerance', type=float, default=1.0, help='allowed slowdown / peak memory growth, 1.0 = 100%%')
+    args = parser.parse_args()
+
+    results = run_suite(args.rows, args.price_cols, args.repeat, args.min_time, args.seed)
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(),
+                       'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}, f, indent=1)
+        print(f'\nSaved {len(results)} results to {args.save}')
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        speed = machine_speed(results, baseline['results'])
+        print(f'\nthis machine takes {speed:.2f}x the time of the baseline run (median of the benchmarks)')
+        regressions = compare(results, baseline['results'], args.tolerance, speed)
+        if regressions:
+            print(f'\n{len(regressions)} regressions: {", ".join(regressions)}')
+            sys.exit(1)
+        print('\nNo regressions')
+
+
+if __name__ == '__main__':
+    main()
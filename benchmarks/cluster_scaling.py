@@ -0,0 +1,81 @@
+"""Throughput of the multi-process mode with CPU-bound handlers, 1 vs N worker processes.
+
+The updates of --users simulated users are routed by cluster.shard_of to the workers started by
+cluster.start_workers, the same way the ingress does it. Every update costs the worker a cold render of
+a price table and a models list from a synthetic catalog (what a handler pays on a render cache miss).
+Scaling is bounded by the cores of the machine, the script prints how many it sees.
+
+    python benchmarks/cluster_scaling.py --users 200 --updates 10 --workers 1 2 4
+"""
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from cluster import shard_of, start_workers
+from concurrent_updates import make_updates
+
+
+def bench_worker(index, workers, queue, rows, done):
+    from tabulate import tabulate
+
+    from catalog_sync import CatalogSync
+    from synthetic import make_values
+
+    catalog = CatalogSync(lambda: make_values(rows)).sync()
+    models = list(catalog.records)
+    done.put('ready')
+    handled = 0
+    while True:
+        data = queue.get()
+        if data is None:
+            break
+        record = catalog.get_record(models[data['update_id'] % len(models)])
+        tabulate(record.prices, ['Срок', 'Стоимость'], tablefmt='outline')
+        '\n'.join(f'{i}. {model}' for i, model in enumerate(catalog.get_models(record.tool), 1))
+        handled += 1
+    done.put(handled)
+
+
+def run(updates, workers, rows):
+    import multiprocessing
+    done = multiprocessing.get_context('spawn').Queue()
+    processes, queues = start_workers(workers, target=bench_worker, args=(rows, done))
+    for _ in processes: #wait until every worker built its catalog
+        done.get(timeout=600)
+
+    started = time.perf_counter()
+    for update in updates:
+        queues[shard_of(update, workers)].put(update.to_dict())
+    for queue in queues:
+        queue.put(None)
+    handled = sum(done.get(timeout=600) for _ in processes)
+    elapsed = time.perf_counter() - started
+
+    for process in processes:
+        process.join()
+    assert handled == len(updates), (handled, len(updates))
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--updates', type=int, default=10, help='updates per user')
+    parser.add_argument('--rows', type=int, default=2000, help='rows of the synthetic catalog')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    args = parser.parse_args()
+
+    updates = make_updates(args.users, args.updates)
+    print(f'{len(updates)} updates from {args.users} users, {os.cpu_count()} cpus')
+    print(f'{"workers":>8} {"seconds":>9} {"updates/s":>10}')
+    for workers in args.workers:
+        elapsed = run(updates, workers, args.rows)
+        print(f'{workers:>8} {elapsed:>9.2f} {len(updates) / elapsed:>10.0f}')
+
+
+if __name__ == '__main__':
+    main()
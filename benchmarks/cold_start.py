@@ -0,0 +1,78 @@
+"""Cold start: how fast the bot has a catalog to serve from the local snapshot vs a fresh sheet sync.
+
+Measures, for a synthetic catalog of --rows rows:
+  - rebuild: cleaning the raw sheet values and building the CatalogSnapshot (what a start without a local file pays on top of the google request)
+  - save / load: writing the local snapshot after a sync and restoring it at boot (CatalogSync.load_local)
+  - process: a fresh interpreter importing the catalog modules and loading the snapshot, i.e. the time until the first update can be served
+
+    python benchmarks/cold_start.py --rows 10000
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from catalog_sync import CatalogSync
+from catalog_store import save_snapshot
+from synthetic import make_values
+
+
+CHILD = '''
+import sys, time
+t0 = time.perf_counter()
+sys.path.insert(0, {root!r})
+from catalog_sync import CatalogSync
+snapshot = CatalogSync(None, snapshot_path={path!r}).load_local()
+print(time.perf_counter() - t0, len(snapshot.records))
+'''
+
+
+
+def timed(fn, repeat=5):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=10_000)
+    parser.add_argument('--price-cols', type=int, default=3)
+    args = parser.parse_args()
+
+    values = make_values(args.rows, args.price_cols)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'catalog_snapshot.bin')
+
+        rebuild_time, _ = timed(lambda: CatalogSync(lambda: values).sync())
+
+        sync = CatalogSync(lambda: values)
+        sync.sync()
+        save_time, _ = timed(lambda: save_snapshot(path, sync.digest, sync.header, sync.records))
+
+        load_time, snapshot = timed(lambda: CatalogSync(None, snapshot_path=path).load_local())
+        assert snapshot.version == sync.digest
+
+        output = subprocess.run([sys.executable, '-c', CHILD.format(root=ROOT, path=path)], capture_output=True, text=True, check=True).stdout
+        process_time = float(output.split()[0])
+
+        print(f'rows: {args.rows}, snapshot file: {os.path.getsize(path) / 1024:.0f} KiB')
+        print(f'rebuild from sheet values: {rebuild_time * 1000:8.1f} ms (+ google request)')
+        print(f'save local snapshot:       {save_time * 1000:8.1f} ms')
+        print(f'load local snapshot:       {load_time * 1000:8.1f} ms')
+        print(f'fresh process to catalog:  {process_time * 1000:8.1f} ms')
+
+
+
+if __name__ == '__main__':
+    main()
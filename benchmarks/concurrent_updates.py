@@ -0,0 +1,89 @@
+"""Update throughput with N users pressing buttons at the same time, sequential vs ChatOrderedUpdateProcessor.
+
+Every simulated user sends --updates updates in a row, the handler of each update waits --latency seconds
+(a Yandex quote or a Bot API call). The updates are dispatched like Application does it: awaited one by one
+for the default sequential processing, a task per update for a concurrent processor. The script also checks
+that the updates of every chat were handled in the order they arrived.
+
+    python benchmarks/concurrent_updates.py --users 200 --updates 5 --latency 0.05
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from telegram import Chat, Message, Update, User
+
+from update_processing import ChatOrderedUpdateProcessor
+
+
+def make_updates(users, updates_per_user, seed=0):
+    """Updates of all the users interleaved randomly, but in order within each user."""
+    date = datetime.datetime.now(datetime.timezone.utc)
+    queues = [[(user, n) for n in range(updates_per_user)] for user in range(users)]
+    rng = random.Random(seed)
+    updates = []
+    while queues:
+        queue = rng.choice(queues)
+        user, n = queue.pop(0)
+        if not queue:
+            queues.remove(queue)
+        chat_id = 1000 + user
+        message = Message(message_id=n, date=date, chat=Chat(chat_id, Chat.PRIVATE),
+                          from_user=User(chat_id, f'user{user}', False), text=str(n))
+        updates.append(Update(len(updates), message=message))
+    return updates
+
+
+async def run(updates, latency, max_workers):
+    seen = {}
+    running = peak = 0
+
+    async def handle(update):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(latency * random.uniform(0.5, 1.5))
+        seen.setdefault(update.effective_chat.id, []).append(update.message.message_id)
+        running -= 1
+
+    started = time.perf_counter()
+    if max_workers == 1: #what Application does without concurrent_updates
+        for update in updates:
+            await handle(update)
+    else:
+        processor = ChatOrderedUpdateProcessor(max_workers=max_workers)
+        tasks = [asyncio.create_task(processor.process_update(update, handle(update))) for update in updates]
+        await asyncio.gather(*tasks)
+        assert not processor._chat_locks, 'chat locks were not released'
+    elapsed = time.perf_counter() - started
+
+    in_order = all(ids == sorted(ids) for ids in seen.values())
+    return elapsed, peak, in_order
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--updates', type=int, default=5, help='updates per user')
+    parser.add_argument('--latency', type=float, default=0.05, help='mean handler time in seconds')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 8, 64, 256])
+    args = parser.parse_args()
+
+    updates = make_updates(args.users, args.updates)
+    print(f'{args.users} users x {args.updates} updates, handler latency ~{args.latency * 1000:.0f} ms')
+    print(f'{"workers":>8} {"seconds":>9} {"updates/s":>10} {"peak":>6}  order')
+
+    for workers in args.workers:
+        elapsed, peak, in_order = asyncio.run(run(updates, args.latency, workers))
+        print(f'{workers:>8} {elapsed:>9.2f} {len(updates) / elapsed:>10.0f} {peak:>6}  {"ok" if in_order else "BROKEN"}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+"""End-to-end load test: simulated renters go through the whole order conversation of the real bot, offline.
+
+The application comes from main.build_application() with all its handlers, caches and jobs; only what is
+outside the process is replaced:
+  - FakeBotRequest: an in-process Bot API (a telegram BaseRequest) answering every method after --bot-api-latency
+  - the geocoder and the Yandex Cargo check-price/tariffs endpoints, served by an httpx.MockTransport after --upstream-latency
+  - the google sheet, by a synthetic catalog of --rows rows (benchmarks/synthetic.py)
+
+Every user goes /start -> tools -> tool number -> model -> prices -> days -> delivery + address (or pick-up) -> confirm,
+with a think time between the steps. The updates are dispatched through the application's update processor like
+Application does it with the updates it fetches. Reports the completed orders per second, p50/p95/p99 of every step
+(from the update to the end of its handler) and how much the memory grew.
+
+    python benchmarks/load_test.py --users 2000 --ramp 10 --think 0.5 --upstream-latency 0.2
+"""
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+#the local files of the bot go to a temporary directory, set before main reads them
+TMP_DIR = tempfile.mkdtemp(prefix='rentatool_load_test_')
+for _name, _file in (('CATALOG_SNAPSHOT_FILE', 'catalog_snapshot.bin'), ('GEOCODE_CACHE_FILE', 'geocode_cache.json'),
+                     ('PHOTO_CACHE_FILE', 'photo_cache.json'), ('DELIVERY_ESTIMATOR_FILE', 'delivery_estimator.json')):
+    os.environ[_name] = os.path.join(TMP_DIR, _file)
+
+import httpx
+from telegram import Update
+from telegram.request import BaseRequest
+
+import geo
+import main as bot
+from yandex_delivery_test import YandexCargoClient
+from synthetic import make_values
+
+
+STREETS = ['Есенина', 'Чапыгина', 'Сикейроса', 'Каменноостровский проспект', 'Невский проспект', 'Садовая', 'Гороховая',
+           'Литейный проспект', 'Марата', 'Лиговский проспект', 'Большая Пушкарская', 'Савушкина']
+
+
+
+class FakeBotRequest(BaseRequest):
+    """Answers the Bot API methods of the bot in-process, remembers the last inline keyboard sent to every chat."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = collections.Counter()
+        self.keyboards = {} #chat id -> callback_data of the buttons of the last keyboard
+        self.invoices = set() #chats that got to the payment
+        self._message_ids = itertools.count(1)
+
+
+    @property
+    def read_timeout(self):
+        return None
+
+
+    async def initialize(self):
+        pass
+
+
+    async def shutdown(self):
+        pass
+
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data is not None else {}
+        self.calls[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+
+        if endpoint == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Rent A Tool', 'username': 'rentatool_load_test_bot'}
+        elif 'chat_id' in params:
+            chat_id = int(params['chat_id'])
+            markup = params.get('reply_markup')
+            if isinstance(markup, str):
+                markup = json.loads(markup)
+            if markup and 'inline_keyboard' in markup:
+                self.keyboards[chat_id] = [button['callback_data'] for row in markup['inline_keyboard']
+                                           for button in row if 'callback_data' in button]
+            if endpoint == 'sendInvoice':
+                self.invoices.add(chat_id)
+            result = {'message_id': params.get('message_id') or next(self._message_ids), 'date': int(time.time()),
+                      'chat': {'id': chat_id, 'type': 'private'}, 'text': params.get('text', '')}
+        else:
+            result = True
+
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+
+def make_upstream_transport(latency=0.0, failure_rate=0.0) -> httpx.MockTransport:
+    """The geocoder and Yandex Cargo: every address gets stable coordinates in St. Petersburg, prices grow with the weight."""
+    async def handler(request: httpx.Request):
+        if latency:
+            await asyncio.sleep(latency * random.uniform(0.5, 1.5))
+        if failure_rate and random.random() < failure_rate:
+            return httpx.Response(503)
+
+        if request.url.host == httpx.URL(geo.GEOCODER_URL).host:
+            rnd = random.Random(request.url.params.get('geocode'))
+            pos = f'{30.2 + rnd.random() * 0.3:.6f} {59.85 + rnd.random() * 0.15:.6f}'
+            return httpx.Response(200, json={'response': {'GeoObjectCollection': {'featureMember': [{'GeoObject': {'Point': {'pos': pos}}}]}}})
+
+        if request.url.path.endswith('/check-price'):
+            body = json.loads(request.content)
+            return httpx.Response(200, json={'price': f'{300 + 25 * body["items"][0]["weight"]:.2f}', 'currency_rules': {'code': 'RUB'}})
+        if request.url.path.endswith('/tariffs'):
+            return httpx.Response(200, json={'available_tariffs': []})
+
+        return httpx.Response(404)
+
+    return httpx.MockTransport(handler)
+
+
+
+class Simulation:
+    def __init__(self, application, fake, args):
+        self.application = application
+        self.fake = fake
+        self.args = args
+        self.latencies = collections.defaultdict(list) #step -> seconds
+        self.failures = collections.Counter() #step at which users dropped out
+        self.completed = 0
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+
+    def message(self, chat_id, text):
+        data = {'message_id': next(self._message_ids), 'date': int(time.time()), 'text': text,
+                'chat': {'id': chat_id, 'type': 'private'}, 'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Renter'}}
+        if text.startswith('/'):
+            data['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return Update.de_json({'update_id': next(self._update_ids), 'message': data}, self.application.bot)
+
+
+    def callback(self, chat_id, callback_data):
+        user = {'id': chat_id, 'is_bot': False, 'first_name': 'Renter'}
+        message = {'message_id': next(self._message_ids), 'date': int(time.time()), 'text': '...',
+                   'chat': {'id': chat_id, 'type': 'private'}}
+        data = {'id': str(next(self._update_ids)), 'from': user, 'chat_instance': str(chat_id), 'data': callback_data, 'message': message}
+        return Update.de_json({'update_id': next(self._update_ids), 'callback_query': data}, self.application.bot)
+
+
+    async def step(self, name, update, expected_state):
+        """Dispatches the update and waits for its handlers, False if the conversation did not get to expected_state."""
+        application = self.application
+        started = time.perf_counter()
+        await application.update_processor.process_update(update, application.process_update(update))
+        self.latencies[name].append(time.perf_counter() - started)
+
+        chat_id = update.effective_chat.id
+        if expected_state == bot.START_PAYMENT:
+            reached = chat_id in self.fake.invoices
+        else:
+            reached = application.bot_data['funnel'].current_state(chat_id) == expected_state
+        if not reached:
+            self.failures[name] += 1
+        return reached
+
+
+    async def think(self, rng):
+        if self.args.think:
+            await asyncio.sleep(rng.expovariate(1 / self.args.think))
+
+
+    async def run_user(self, user: int):
+        args = self.args
+        rng = random.Random(args.seed * 1000003 + user)
+        chat_id = 10 ** 6 + user
+        await asyncio.sleep(args.ramp * user / args.users)
+
+        catalog = self.application.bot_data['catalog']
+        steps = [('start', lambda: self.message(chat_id, '/start'), bot.INFO),
+                 ('tools', lambda: self.callback(chat_id, 'tools_show'), bot.TOOLS_SELECTION),
+                 ('tool', lambda: self.message(chat_id, str(rng.choice(list(catalog.tool_dict)))), bot.CHOICE_PRICE_OR_DETAILS),
+                 ('model', lambda: self.callback(chat_id, rng.choice([data for data in self.fake.keyboards.get(chat_id, ())
+                                                                      if data.endswith('__CALLBACK')] or ['-'])), bot.SHOW_PRICES_OR_DETAILS),
+                 ('prices', lambda: self.callback(chat_id, 'show_chosen_tool_price_list'), bot.DELIVERY_QUESTION),
+                 ('days', lambda: self.message(chat_id, str(rng.randint(1, 7))), bot.DELIVERY_CHOICE)]
+        if rng.random() < args.pickup_share:
+            steps += [('pick_up', lambda: self.callback(chat_id, 'pick_up_tool'), bot.PICK_UP_CONFIRM),
+                      ('pick_up_confirm', lambda: self.callback(chat_id, 'confirm_pick_up'), bot.CONCLUDE_ORDER)]
+        else:
+            address = rng.randrange(args.addresses)
+            address = f'{STREETS[address % len(STREETS)]}, {address // len(STREETS) + 1}, {rng.randint(1, 200)}'
+            steps += [('delivery', lambda: self.callback(chat_id, 'delivery'), bot.DELIVERY_DETAILS),
+                      ('address', lambda: self.message(chat_id, address), bot.CONCLUDE_ORDER)]
+        steps.append(('confirm', lambda: self.callback(chat_id, 'confirm_order'), bot.START_PAYMENT))
+
+        for i, (name, make_update, expected_state) in enumerate(steps):
+            if i:
+                await self.think(rng)
+            if not await self.step(name, make_update(), expected_state):
+                return
+        self.completed += 1
+
+
+
+def rss_mb() -> float:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError: #not linux, the peak is the best there is
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def run(args):
+    fake = FakeBotRequest(latency=args.bot_api_latency)
+    values = make_values(args.rows, seed=args.seed, missing_price_share=0)
+    persistence_path = os.path.join(TMP_DIR, 'bot_state.sqlite3') if args.persistence else ''
+    application = bot.build_application(token='1:load-test', fetch_values=lambda: values, snapshot_path=os.environ['CATALOG_SNAPSHOT_FILE'],
+                                        max_concurrent_updates=args.workers, persistence_path=persistence_path, with_updater=False,
+                                        metrics_port=0, request=fake, rate_limit=args.rate_limit)
+
+    transport = make_upstream_transport(args.upstream_latency, args.upstream_failure_rate)
+    geo._client = httpx.AsyncClient(transport=transport) #picked up by get_geocoder_client()
+
+    #like a start with a local snapshot, the refresh_gsh job then finds the sheet unchanged
+    bot.publish_catalog(application.bot_data, application.bot_data['catalog_sync'].sync())
+
+    async with application:
+        await bot.post_init(application)
+        await application.bot_data['yandex_client'].aclose()
+        application.bot_data['yandex_client'] = YandexCargoClient('load-test', client=httpx.AsyncClient(transport=transport),
+                                                                  geocode_cache=application.bot_data['geocode_cache'], **bot.YANDEX_HTTP_SETTINGS)
+        await application.start()
+
+        simulation = Simulation(application, fake, args)
+        rss_before = peak = rss_mb()
+        if args.tracemalloc:
+            tracemalloc.start(10)
+            traced_before = tracemalloc.take_snapshot()
+
+        started = time.perf_counter()
+        users = asyncio.gather(*(simulation.run_user(user) for user in range(args.users)))
+        while not users.done():
+            await asyncio.wait([users], timeout=0.25)
+            peak = max(peak, rss_mb())
+        await users
+        elapsed = time.perf_counter() - started
+        rss_after = rss_mb()
+        traced_after = tracemalloc.take_snapshot() if args.tracemalloc else None
+
+        await application.stop()
+    await bot.post_shutdown(application)
+
+    updates = sum(len(latencies) for latencies in simulation.latencies.values())
+    print(f'{args.users} users, {args.rows} catalog rows, {args.workers} concurrent updates, think ~{args.think}s, '
+          f'bot api ~{args.bot_api_latency * 1000:.0f} ms, upstream ~{args.upstream_latency * 1000:.0f} ms, '
+          f'rate limiter {"on" if args.rate_limit else "off"}, persistence {"on" if args.persistence else "off"}')
+    print(f'{simulation.completed} orders completed in {elapsed:.2f}s: {simulation.completed / elapsed:.1f} orders/s, {updates / elapsed:.0f} updates/s')
+    if simulation.failures:
+        print(f'users dropped out at: {dict(simulation.failures)}')
+
+    print(f'\n{"step":>16} {"count":>7} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"max ms":>8}')
+    for name, latencies in simulation.latencies.items():
+        latencies.sort()
+        print(f'{name:>16} {len(latencies):>7} ' + ' '.join(f'{value * 1000:>8.1f}' for value in
+              (percentile(latencies, 0.5), percentile(latencies, 0.95), percentile(latencies, 0.99), latencies[-1])))
+
+    print(f'\nmemory: rss {rss_before:.1f} -> {rss_after:.1f} MB (peak {peak:.1f}), '
+          f'{(rss_after - rss_before) * 1024 / max(args.users, 1):.1f} KB per user')
+    if traced_after is not None:
+        print('largest allocation growth:')
+        for stat in traced_after.compare_to(traced_before, 'lineno')[:10]:
+            print(f'  {stat}')
+
+    bot_data = application.bot_data
+    print(f'\nbot api calls: {dict(fake.calls)}')
+    print(f'geocode cache: {bot_data["geocode_cache"].stats}, quotes: {bot_data["yandex_client"].quote_stats}, '
+          f'render cache: {bot_data["render_cache"].stats}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline end-to-end load test of the order conversation')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--ramp', type=float, default=5.0, help='seconds over which the users arrive')
+    parser.add_argument('--think', type=float, default=0.0, help='mean pause of a user between two steps, seconds')
+    parser.add_argument('--rows', type=int, default=500, help='rows of the synthetic catalog')
+    parser.add_argument('--addresses', type=int, default=1000, help='distinct delivery addresses the users pick from')
+    parser.add_argument('--pickup-share', type=float, default=0.3, help='share of the users choosing pick-up over delivery')
+    parser.add_argument('--bot-api-latency', type=float, default=0.03, help='mean Bot API response time, seconds')
+    parser.add_argument('--upstream-latency', type=float, default=0.1, help='mean geocoder and Yandex response time, seconds')
+    parser.add_argument('--upstream-failure-rate', type=float, default=0.0, help='share of the upstream requests answered with a 503')
+    parser.add_argument('--workers', type=int, default=bot.MAX_CONCURRENT_UPDATES, help='updates handled at the same time (1 = sequential)')
+    parser.add_argument('--rate-limit', action='store_true', help="send through the TokenBucketRateLimiter (telegram's limits then cap the throughput)")
+    parser.add_argument('--persistence', action='store_true', help='persist conversations and sessions in SQLite')
+    parser.add_argument('--tracemalloc', action='store_true', help='trace the allocations (slow) and show where the memory grew')
+    parser.add_argument('--log-level', default='WARNING', help="level of the bot's own logger during the run")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(args.log_level)
+    bot.main_logger.setLevel(args.log_level)
+    random.seed(args.seed)
+    try:
+        asyncio.run(run(args))
+    finally:
+        shutil.rmtree(TMP_DIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
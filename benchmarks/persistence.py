@@ -0,0 +1,98 @@
+"""Persistence cost: SQLitePersistence vs the stock PicklePersistence of python-telegram-bot.
+
+  - full round: event loop time per user of handing every session and conversation state to the persistence,
+    and the total time until they are on disk
+  - one user: a round where a single user out of --users changed, until it is on disk; PicklePersistence
+    (default on_flush=False) rewrites the whole file on the event loop for it
+  - recovery: a new persistence reading all the sessions and conversation states back, as at startup
+  - file size
+
+    python benchmarks/persistence.py --users 10000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from telegram.ext import PersistenceInput, PicklePersistence
+
+from persistence import SQLitePersistence
+from session import OrderSession
+
+
+CONVERSATION = 'order_conversation'
+
+
+def make_sessions(users):
+    return {1000 + i: {'session': OrderSession('3f9a1c0e6b2d4e8a', f'Перфоратор {i % 40}', i % 900, 1 + i % 14, f'Есенина, {i % 60}, {i % 200}')}
+            for i in range(users)}
+
+
+async def write_all(persistence, sessions):
+    """One update_persistence round with every user active, returns (loop seconds, total seconds)."""
+    started = time.perf_counter()
+    for user_id, data in sessions.items():
+        await persistence.update_user_data(user_id, data)
+        await persistence.update_conversation(CONVERSATION, (user_id, user_id), 7)
+    loop_time = time.perf_counter() - started
+    await persistence.flush()
+    return loop_time, time.perf_counter() - started
+
+
+async def write_one(path, kind, sessions, rounds=20):
+    """Average seconds of a persistence round in which only one user changed, with all the users already stored."""
+    persistence = make_persistence(kind, path, on_flush=False)
+    await persistence.get_user_data()
+    await persistence.get_conversations(CONVERSATION)
+    started = time.perf_counter()
+    for user_id in list(sessions)[:rounds]:
+        await persistence.update_user_data(user_id, sessions[user_id])
+        await persistence.update_conversation(CONVERSATION, (user_id, user_id), 8)
+        if kind == 'sqlite':
+            await persistence._writer
+    elapsed = time.perf_counter() - started
+    await persistence.flush()
+    return elapsed / rounds
+
+
+async def read_all(persistence):
+    started = time.perf_counter()
+    user_data = await persistence.get_user_data()
+    conversations = await persistence.get_conversations(CONVERSATION)
+    return time.perf_counter() - started, len(user_data), len(conversations)
+
+
+def make_persistence(kind, path, on_flush=True):
+    if kind == 'sqlite':
+        return SQLitePersistence(path)
+    return PicklePersistence(path, store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False), on_flush=on_flush)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=10_000)
+    args = parser.parse_args()
+
+    sessions = make_sessions(args.users)
+    print(f'{args.users} users with an open order')
+    print(f'{"backend":>8} {"round us/user":>14} {"round ms":>9} {"one user ms":>12} {"recover ms":>11} {"size KB":>8}')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for kind in ('pickle', 'sqlite'):
+            path = os.path.join(tmp, f'state.{kind}')
+            loop_time, total_time = asyncio.run(write_all(make_persistence(kind, path), sessions))
+            recover_time, users, conversations = asyncio.run(read_all(make_persistence(kind, path)))
+            assert users == conversations == args.users, (users, conversations)
+            size = sum(os.path.getsize(os.path.join(tmp, name)) for name in os.listdir(tmp) if name.startswith(f'state.{kind}'))
+            one_time = asyncio.run(write_one(path, kind, sessions))
+            print(f'{kind:>8} {loop_time / args.users * 1e6:>14.1f} {total_time * 1000:>9.1f} {one_time * 1000:>12.2f} '
+                  f'{recover_time * 1000:>11.1f} {size / 1024:>8.0f}')
+
+
+if __name__ == '__main__':
+    main()
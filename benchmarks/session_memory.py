@@ -0,0 +1,80 @@
+"""Per-user memory footprint of the order session state.
+
+Simulates N open conversations (100k by default) in the state right before confirm_order and reports the
+traced memory per user for the OrderSession layout. If pandas is installed the old layout (DataFrame slices
+in user_data) is measured too, on fewer users since it is orders of magnitude heavier.
+
+    python benchmarks/session_memory.py --sessions 100000
+"""
+import argparse
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from session import OrderSession
+
+
+PRICE_COLS = ['Стоимость 1 день', 'Стоимость 3 дня', 'Стоимость 7 дней', 'Стоимость 30 дней']
+
+
+
+def measure(build, n):
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    sessions = [build(i) for i in range(n)]
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    del sessions
+    return (after - before) / n, peak
+
+
+def build_compact(i):
+    session = OrderSession(snapshot_version='3f1c9a0b7e2d4c11', tool='Перфоратор', model_key=f'Makita HR{i % 500}', days=i % 30 + 1, address=f'Есенина, {i % 200}, {i % 90}')
+    return {'session': session}
+
+
+def build_legacy_factory():
+    import pandas as pd
+
+    row = {'Инструмент': 'Перфоратор', 'Бренд': 'Makita', 'Модель': 'HR2470', 'picture_url': 'https://example.com/hr2470.jpg',
+           'detail_power': '780 Вт', 'detail_weight (kg)': '2.9', 'model_index': 'Makita HR2470'}
+    row.update({col: '500' for col in PRICE_COLS})
+    full_df = pd.DataFrame([row] * 200)
+
+    def build_legacy(i):
+        specific_model_row = full_df.iloc[[i % 200]]
+        price_df = specific_model_row[PRICE_COLS]
+        price_df.columns = [col.replace('Стоимость ', '') for col in PRICE_COLS]
+        return {'tools_shown_flag': True, 'chosen_tool': 'Перфоратор', 'chosen_model': f'Makita HR{i % 500}',
+                'specific_model_row': specific_model_row, 'prices_for_chosen_tool': price_df.T,
+                'days_to_rent_tool': i % 30 + 1, 'delivery_address': f'Есенина, {i % 200}, {i % 90}'}
+
+    return build_legacy
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, default=100_000)
+    parser.add_argument('--legacy-sessions', type=int, default=2_000)
+    args = parser.parse_args()
+
+    per_user, peak = measure(build_compact, args.sessions)
+    print(f'OrderSession: {args.sessions} sessions, {per_user:.0f} B/user, {per_user * args.sessions / 2**20:.1f} MiB total, peak {peak / 2**20:.1f} MiB')
+
+    try:
+        build_legacy = build_legacy_factory()
+    except ImportError:
+        print('pandas is not installed, skipping the DataFrame layout')
+        return
+
+    per_user_legacy, _ = measure(build_legacy, args.legacy_sessions)
+    print(f'DataFrames in user_data: {args.legacy_sessions} sessions, {per_user_legacy:.0f} B/user, '
+          f'~{per_user_legacy * args.sessions / 2**20:.1f} MiB extrapolated to {args.sessions} sessions')
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Startup import guard: imports the bot module in a fresh interpreter with -X importtime.
+
+Reports the total import time, the slowest top-level imports and fails (exit code 1) when
+  - one of the ingestion-only packages (pandas, numpy, googleapiclient, tabulate) is imported at startup, or
+  - the total import time is above --max-ms.
+
+    python benchmarks/startup_imports.py --module main --max-ms 600
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#these are only needed by the catalog refresh worker and must stay off the serving path
+DEFERRED_MODULES = ('pandas', 'numpy', 'googleapiclient', 'tabulate')
+
+
+
+def import_times(module: str):
+    """Returns [(self_us, cumulative_us, depth, name), ...] parsed from the -X importtime output."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=ROOT, capture_output=True, text=True)
+    if result.returncode != 0:
+        sys.stderr.write(result.stderr)
+        raise SystemExit(f'importing {module} failed')
+
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2 #one space after the separator, then two per nesting level
+        rows.append((int(self_us), int(cumulative_us), depth, name.strip()))
+
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--module', default='main')
+    parser.add_argument('--max-ms', type=float, default=600.0)
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    rows = import_times(args.module)
+    top_level = [row for row in rows if row[2] == 0]
+    total_ms = sum(row[1] for row in top_level) / 1000
+
+    print(f'total import time of {args.module}: {total_ms:.1f} ms')
+    for self_us, cumulative_us, _, name in sorted(top_level, key=lambda row: -row[1])[:args.top]:
+        print(f'  {cumulative_us / 1000:8.1f} ms  {name}')
+
+    imported = {row[3] for row in rows}
+    deferred = [name for name in DEFERRED_MODULES if name in imported]
+
+    failed = False
+    if deferred:
+        print(f'FAIL: deferred modules imported at startup: {", ".join(deferred)}')
+        failed = True
+    if total_ms > args.max_ms:
+        print(f'FAIL: import time {total_ms:.1f} ms is above the {args.max_ms:.0f} ms budget')
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+"""Synthetic catalogs shaped like the Google Sheet (header row first, all cells strings)."""
+import random
+
+
+PRICE_TERMS = ['1 день', '3 дня', '7 дней', '30 дней', '60 дней', '90 дней', '180 дней', '365 дней']
+TOOLS = ['Перфоратор', 'Дрель', 'Шуруповерт', 'Бетономешалка', 'Генератор', 'Сварочный аппарат', 'Болгарка', 'Лобзик',
+         'Виброплита', 'Тепловая пушка', 'Пылесос строительный', 'Компрессор', 'Отбойный молоток', 'Циркулярная пила']
+BRANDS = ['Makita', 'Bosch', 'DeWalt', 'Интерскол', 'Зубр', 'Пульсар', 'Metabo', 'Hilti']
+
+
+
+def make_header(price_cols: int = 3) -> list:
+    return (['Инструмент', 'Бренд', 'Модель'] + [f'Стоимость {term}' for term in PRICE_TERMS[:price_cols]] +
+            ['picture_url', 'detail_power', 'detail_weight (kg)'])
+
+
+def make_values(rows: int, price_cols: int = 3, seed: int = 0, missing_price_share: float = 0.05) -> list:
+    rnd = random.Random(seed)
+    values = [make_header(price_cols)]
+    for i in range(rows):
+        tool = TOOLS[i % len(TOOLS)] if rows <= 1000 else f'{TOOLS[i % len(TOOLS)]} {i // 1000}'
+        brand = BRANDS[rnd.randrange(len(BRANDS))]
+        model = f'M-{i}'
+        prices = [str(rnd.randrange(300, 3000)) for _ in range(price_cols)]
+        if rnd.random() < missing_price_share:
+            prices[-1] = ''
+        values.append([tool, brand, model] + prices + [f'https://example.com/pictures/{i}.jpg', f'{rnd.randrange(500, 2500)} Вт', f'{rnd.uniform(1, 40):.1f}'])
+
+    return values
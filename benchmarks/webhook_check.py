@@ -0,0 +1,301 @@
+"""Webhook mode against a fake Bot API: the secret token check, and the delivery latency compared with polling.
+
+The bot from main.build_application() is started with Application.run_webhook like main.main() does it, then
+with run_polling, both times with base_url pointing at FakeBotApi, a local http server in a thread that answers
+the Bot API methods, remembers the secret_token registered by setWebhook and when the replies to every chat arrive.
+
+  - secret token: an update is posted to the webhook without the X-Telegram-Bot-Api-Secret-Token header, with a
+    wrong one and with the registered one; the first two must be refused (403) and not answered, the last one answered
+  - latency: --updates /start messages of different users, one after another, from posting the update (webhook)
+    or handing it to the fake getUpdates (polling) until the bot's reply reaches the fake Bot API
+
+The fake getUpdates returns as soon as an update is queued, the best case of long polling; against telegram's
+servers polling also pays the round trip of the next getUpdates call. Exits with 1 when a secret token check fails.
+
+    python benchmarks/webhook_check.py --updates 200
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import queue
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+#the local files of the bot go to a temporary directory, set before main reads them
+TMP_DIR = tempfile.mkdtemp(prefix='rentatool_webhook_check_')
+for _name, _file in (('CATALOG_SNAPSHOT_FILE', 'catalog_snapshot.bin'), ('GEOCODE_CACHE_FILE', 'geocode_cache.json'),
+                     ('PHOTO_CACHE_FILE', 'photo_cache.json'), ('DELIVERY_ESTIMATOR_FILE', 'delivery_estimator.json')):
+    os.environ[_name] = os.path.join(TMP_DIR, _file)
+
+from telegram import Update
+
+import main as bot
+from synthetic import make_values
+
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+#seconds to wait for a reply before the update counts as lost
+REPLY_TIMEOUT = 10.0
+
+
+
+class FakeBotApiHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('application/json'):
+            params = json.loads(body or b'{}')
+        else: #PTB sends the parameters form encoded, the non-string ones as json
+            params = {key: values[0] for key, values in urllib.parse.parse_qs(body.decode()).items()}
+
+        result = self.server.call(self.path.rsplit('/', 1)[-1], params)
+        answer = json.dumps({'ok': True, 'result': result}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(answer)))
+        self.end_headers()
+        self.wfile.write(answer)
+
+
+
+class FakeBotApi(ThreadingHTTPServer):
+    """The Bot API methods the bot calls, served over http from a background thread."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeBotApiHandler)
+        self.url = f'http://127.0.0.1:{self.server_address[1]}'
+        self.secret_token = None
+        self.webhook_set = threading.Event()
+        self.updates = queue.Queue() #what the next getUpdates returns
+        self.replies = {} #chat id -> perf_counter() of the first message sent to it
+        self._replied = threading.Condition()
+        self._message_ids = itertools.count(1)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+    def call(self, method: str, params: dict):
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Rent A Tool', 'username': 'rentatool_webhook_check_bot'}
+        if method == 'setWebhook':
+            self.secret_token = params.get('secret_token')
+            self.webhook_set.set()
+            return True
+        if method == 'getUpdates':
+            return self.get_updates(float(params.get('timeout', 0)))
+        if 'chat_id' in params:
+            chat_id = int(params['chat_id'])
+            with self._replied:
+                self.replies.setdefault(chat_id, time.perf_counter())
+                self._replied.notify_all()
+            return {'message_id': next(self._message_ids), 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'},
+                    'text': params.get('text', '')}
+        return True
+
+
+    def get_updates(self, timeout: float) -> list:
+        """Long polling: waits up to timeout for the first update, then returns all the queued ones."""
+        try:
+            updates = [self.updates.get(timeout=timeout) if timeout else self.updates.get_nowait()]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                updates.append(self.updates.get_nowait())
+            except queue.Empty:
+                return updates
+
+
+    def wait_reply(self, chat_id: int, timeout: float = REPLY_TIMEOUT):
+        """perf_counter() at which the first message to chat_id arrived, None if none did within timeout."""
+        with self._replied:
+            self._replied.wait_for(lambda: chat_id in self.replies, timeout)
+            return self.replies.get(chat_id)
+
+
+
+def start_update(update_id: int, chat_id: int) -> dict:
+    user = {'id': chat_id, 'is_bot': False, 'first_name': 'Renter'}
+    return {'update_id': update_id, 'message': {'message_id': update_id, 'date': int(time.time()), 'text': '/start',
+                                                'chat': {'id': chat_id, 'type': 'private'}, 'from': user,
+                                                'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}]}}
+
+
+def post_update(url: str, update: dict, secret_token=None) -> int:
+    """POSTs the update like telegram does, returns the http status of the webhook server."""
+    headers = {'Content-Type': 'application/json'}
+    if secret_token is not None:
+        headers[SECRET_HEADER] = secret_token
+    request = urllib.request.Request(url, data=json.dumps(update).encode(), headers=headers, method='POST')
+    try:
+        with urllib.request.urlopen(request, timeout=REPLY_TIMEOUT) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def run_bot(args, fake: FakeBotApi, run, drive):
+    """Builds a fresh bot, runs run(application) (run_webhook / run_polling) in this thread and drive() in another one
+    once the bot is up; the bot is stopped when drive returns. Returns what drive returned."""
+    values = make_values(args.rows, seed=args.seed)
+    application = bot.build_application(token='1:webhook-check', base_url=fake.url, fetch_values=lambda: values,
+                                        snapshot_path=os.environ['CATALOG_SNAPSHOT_FILE'], persistence_path='',
+                                        metrics_port=0, rate_limit=args.rate_limit)
+    #run_webhook/run_polling close their loop when they return, every run gets a new one the driver can stop
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    outcome = {}
+
+    def driver():
+        #running is set by application.start(), after the updater started polling or serving the webhook
+        deadline = time.monotonic() + REPLY_TIMEOUT
+        while not application.running and time.monotonic() < deadline:
+            time.sleep(0.05)
+        try:
+            outcome['result'] = drive()
+        except BaseException as e:
+            outcome['error'] = e
+        finally:
+            loop.call_soon_threadsafe(application.stop_running)
+
+    thread = threading.Thread(target=driver, daemon=True)
+    thread.start()
+    run(application)
+    thread.join()
+
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome['result']
+
+
+def check_webhook(args, fake: FakeBotApi) -> tuple:
+    """(secret token checks as (description, passed), delivery latencies) of the webhook mode."""
+    port = free_port()
+    webhook_url = f'http://127.0.0.1:{port}/webhook'
+    secret_token = 'webhook-check-secret'
+    chat_ids = itertools.count(10 ** 6)
+
+    def drive():
+        if not fake.webhook_set.wait(REPLY_TIMEOUT):
+            raise RuntimeError('The bot did not call setWebhook')
+        checks = [('setWebhook registers the secret token', fake.secret_token == secret_token)]
+
+        refused = []
+        for description, header in (('without the secret token header', None), ('with a wrong secret token', 'wrong-secret')):
+            chat_id = next(chat_ids)
+            status = post_update(webhook_url, start_update(chat_id, chat_id), header)
+            checks.append((f'update {description} is refused (got {status})', status == 403))
+            refused.append((description, chat_id))
+
+        latencies = []
+        for _ in range(args.updates):
+            chat_id = next(chat_ids)
+            started = time.perf_counter()
+            status = post_update(webhook_url, start_update(chat_id, chat_id), fake.secret_token)
+            replied = fake.wait_reply(chat_id)
+            if status != 200 or replied is None:
+                checks.append((f'update with the secret token is accepted and answered (got {status})', False))
+                break
+            latencies.append(replied - started)
+        else:
+            checks.append(('updates with the secret token are accepted and answered', True))
+
+        for description, chat_id in refused:
+            checks.append((f'update {description} is not answered', fake.wait_reply(chat_id, timeout=0.5) is None))
+        return checks, latencies
+
+    #the same arguments as main.main() gives it in webhook mode
+    run = lambda application: application.run_webhook(listen='127.0.0.1', port=port, url_path='webhook', webhook_url=webhook_url,
+                                                       secret_token=secret_token, allowed_updates=Update.ALL_TYPES)
+    return run_bot(args, fake, run, drive)
+
+
+def check_polling(args, fake: FakeBotApi) -> list:
+    """Delivery latencies of the polling mode."""
+    chat_ids = itertools.count(2 * 10 ** 6)
+    update_ids = itertools.count(1)
+
+    def drive():
+        latencies = []
+        for _ in range(args.updates):
+            chat_id = next(chat_ids)
+            started = time.perf_counter()
+            fake.updates.put(start_update(next(update_ids), chat_id))
+            replied = fake.wait_reply(chat_id)
+            if replied is None:
+                raise RuntimeError(f'The update of chat {chat_id} was not answered in polling mode')
+            latencies.append(replied - started)
+        return latencies
+
+    return run_bot(args, fake, lambda application: application.run_polling(), drive)
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Webhook mode against a fake Bot API')
+    parser.add_argument('--updates', type=int, default=100, help='/start updates delivered in every mode')
+    parser.add_argument('--rows', type=int, default=500, help='rows of the synthetic catalog')
+    parser.add_argument('--rate-limit', action='store_true', help='send the replies through the TokenBucketRateLimiter')
+    parser.add_argument('--log-level', default='WARNING', help="level of the bot's loggers during the run")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(args.log_level)
+    fake = FakeBotApi()
+    try:
+        checks, webhook_latencies = check_webhook(args, fake)
+        polling_latencies = check_polling(args, fake)
+    finally:
+        fake.shutdown()
+        shutil.rmtree(TMP_DIR, ignore_errors=True)
+
+    print('webhook secret token:')
+    for description, passed in checks:
+        print(f'  {"ok  " if passed else "FAIL"} {description}')
+
+    print(f'\ndelivery of an update until the reply reaches the Bot API, {args.updates} updates per mode')
+    print(f'{"mode":>8} {"count":>6} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"max ms":>8}')
+    for mode, latencies in (('webhook', webhook_latencies), ('polling', polling_latencies)):
+        if not latencies:
+            print(f'{mode:>8} {0:>6}')
+            continue
+        latencies.sort()
+        print(f'{mode:>8} {len(latencies):>6} ' + ' '.join(f'{value * 1000:>8.1f}' for value in
+              (percentile(latencies, 0.5), percentile(latencies, 0.95), percentile(latencies, 0.99), latencies[-1])))
+
+    failed = [description for description, passed in checks if not passed]
+    if failed:
+        print(f'\n{len(failed)} secret token checks failed')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
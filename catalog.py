@@ -0,0 +1,85 @@
+from typing import NamedTuple
+
+
+
+class ModelRecord(NamedTuple):
+    model_index: str
+    tool: str
+    prices: tuple #((term label, price), ...) in sheet column order
+    weight: str
+    picture_url: str
+    details: str
+    position: int #row number of the record in the cleaned catalog
+
+
+
+class CatalogSnapshot:
+    """Immutable lookup structure built once per catalog refresh, so that handlers never scan the whole catalog.
+
+    - tool_dict: number shown to the user -> tool
+    - models_by_tool: tool -> ordered tuple of the model_index values offered for it
+    - records: model_index -> ModelRecord (first row of the model wins, like drop_duplicates did)
+    """
+
+    __slots__ = ('version', 'columns', 'price_labels', 'tool_dict', 'tool_list_text', 'models_by_tool', 'records')
+
+    def __init__(self, version, columns, price_labels, tool_dict, tool_list_text, models_by_tool, records):
+        self.version = version
+        self.columns = columns
+        self.price_labels = price_labels
+        self.tool_dict = tool_dict
+        self.tool_list_text = tool_list_text
+        self.models_by_tool = models_by_tool
+        self.records = records
+
+
+    @classmethod
+    def from_records(cls, version: str, columns: list, records: list):
+        """Builds the snapshot from the cleaned catalog rows (dicts keyed by the sheet columns plus model_index)."""
+        price_cols = [col for col in columns if 'Стоимость' in col]
+        price_labels = tuple(col.replace('Стоимость ', '') for col in price_cols)
+
+        tools = []
+        models_by_tool = {}
+        records_by_model = {}
+        for position, row in enumerate(records):
+            tool = row.get('Инструмент')
+            model_index = row['model_index']
+
+            if tool is not None and tool not in models_by_tool:
+                tools.append(tool)
+                models_by_tool[tool] = []
+
+            if model_index is not None and model_index not in records_by_model:
+                records_by_model[model_index] = ModelRecord(model_index=model_index,
+                                                            tool=tool,
+                                                            prices=tuple(zip(price_labels, (row[col] for col in price_cols))),
+                                                            weight=row.get('detail_weight (kg)'),
+                                                            picture_url=row.get('picture_url'),
+                                                            details=row.get('detail_power'),
+                                                            position=position)
+
+            #models without a proper name in the sheet are not offered to the user
+            if tool is None or model_index is None or row.get('Модель') == '-':
+                continue
+            if model_index not in models_by_tool[tool]:
+                models_by_tool[tool].append(model_index)
+
+        tool_dict = {i+1: tool for i, tool in enumerate(tools)}
+        tool_list_text = '\n'.join(f"{i}. {tool}" for i, tool in tool_dict.items())
+
+        return cls(version=version,
+                   columns=tuple(columns),
+                   price_labels=price_labels,
+                   tool_dict=tool_dict,
+                   tool_list_text=tool_list_text,
+                   models_by_tool={tool: tuple(models) for tool, models in models_by_tool.items()},
+                   records=records_by_model)
+
+
+    def get_record(self, model_index: str):
+        return self.records.get(model_index)
+
+
+    def get_models(self, tool: str) -> tuple:
+        return self.models_by_tool.get(tool, ())
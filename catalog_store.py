@@ -0,0 +1,45 @@
+import logging
+import os
+import pickle
+
+
+logger = logging.getLogger(__name__)
+
+
+#bump when the layout below changes, files with another format are ignored
+SNAPSHOT_FORMAT = 1
+
+
+
+def save_snapshot(path: str, version: str, columns: list, records: list):
+    """Writes the cleaned catalog rows column by column, the file is replaced atomically."""
+    all_columns = list(columns) + ['model_index']
+    data = {col: [record[col] for record in records] for col in all_columns}
+    payload = {'format': SNAPSHOT_FORMAT, 'version': version, 'columns': list(columns), 'rows': len(records), 'data': data}
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def load_snapshot(path: str):
+    """Returns (version, columns, records) from a file written by save_snapshot, or None if there is no usable file."""
+    try:
+        with open(path, 'rb') as f:
+            payload = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning('Could not read the local catalog snapshot %s: %s', path, e)
+        return None
+
+    if payload.get('format') != SNAPSHOT_FORMAT:
+        logger.warning('Ignoring the local catalog snapshot %s written in format %s', path, payload.get('format'))
+        return None
+
+    data = payload['data']
+    names = list(data)
+    records = [dict(zip(names, values)) for values in zip(*data.values())] if payload['rows'] else []
+
+    return payload['version'], payload['columns'], records
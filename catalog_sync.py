@@ -0,0 +1,134 @@
+import hashlib
+import json
+import logging
+
+from catalog import CatalogSnapshot
+from catalog_store import save_snapshot, load_snapshot
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+
+def clean_row(header: list, price_cols: list, row: list):
+    """Cleans one sheet row: returns the record with the unique key model_index (Brand + Model), or None if the row has no prices."""
+    #the sheets api drops trailing empty cells, so short rows are padded up to the header length
+    row = list(row[:len(header)]) + [''] * (len(header) - len(row))
+    record = {col: (None if value == '' else value) for col, value in zip(header, row)}
+
+    if any(record[col] is None for col in price_cols):
+        return None
+
+    brand, model = record.get('Бренд'), record.get('Модель')
+    record['model_index'] = brand + ' ' + model if (brand is not None and model is not None) else None
+
+    return record
+
+
+
+class CatalogSync:
+    """Keeps the cleaned catalog in sync with the sheet, skipping the rebuild when the raw values did not change.
+
+    Cleaned rows are cached by their raw content, so when a few rows change only those rows are parsed
+    and cleaned again. Only the row cleaning is incremental: the CatalogSnapshot is built from all the records
+    again and the render cache starts empty for the new version.
+
+    If snapshot_path is given every rebuilt catalog is also written there, so that the next start can serve
+    the last known catalog (load_local) before google answers.
+    """
+
+    def __init__(self, fetch_values, snapshot_path=None):
+        self.fetch_values = fetch_values #callable returning the raw 'values' list of the sheet (header row first)
+        self.snapshot_path = snapshot_path
+
+        self.digest = None
+        self.header = None
+        self.snapshot = None
+        self.records = []
+        self._row_cache = {}  #tuple(raw row) -> cleaned record (None for rows without prices)
+
+        self.stats = {'fetched': 0, 'skipped': 0, 'rebuilt': 0, 'rows_reused': 0, 'rows_rebuilt': 0}
+
+
+    @staticmethod
+    def values_digest(values: list) -> str:
+        return hashlib.blake2b(json.dumps(values, ensure_ascii=False).encode(), digest_size=16).hexdigest()
+
+
+    def sync(self):
+        """Fetches the sheet and returns the new CatalogSnapshot, or None if nothing changed since the last sync."""
+        values = self.fetch_values()
+        self.stats['fetched'] += 1
+
+        digest = self.values_digest(values)
+        if digest == self.digest:
+            self.stats['skipped'] += 1
+            return None
+
+        with metrics.track(metrics.CATALOG_REBUILD_SECONDS):
+            self.snapshot = self.rebuild(values, digest)
+        self.digest = digest
+        self.stats['rebuilt'] += 1
+
+        if self.snapshot_path:
+            try:
+                save_snapshot(self.snapshot_path, digest, self.header, self.records)
+            except OSError as e:
+                logger.warning('Could not write the local catalog snapshot: %s', e)
+
+        return self.snapshot
+
+
+    def rebuild(self, values: list, version: str) -> CatalogSnapshot:
+        header = list(values[0]) if values else []
+        if header != self.header: #the columns changed, none of the cached rows can be reused
+            self._row_cache = {}
+            self.header = header
+
+        price_cols = [col for col in header if 'Стоимость ' in col]
+
+        old_cache = self._row_cache
+        new_cache = {}
+        records = []
+        reused = rebuilt = 0
+        for row in values[1:]:
+            key = tuple(row)
+            if key in new_cache:
+                record = new_cache[key]
+            elif key in old_cache:
+                record = new_cache[key] = old_cache[key]
+                reused += 1
+            else:
+                record = new_cache[key] = clean_row(header, price_cols, row)
+                rebuilt += 1
+
+            if record is not None:
+                records.append(record)
+
+        self._row_cache = new_cache
+        self.records = records
+        self.stats['rows_reused'] += reused
+        self.stats['rows_rebuilt'] += rebuilt
+
+        logger.debug('Catalog rebuilt: %s rows reused, %s rows rebuilt', reused, rebuilt)
+
+        return CatalogSnapshot.from_records(version, header, records)
+
+
+    def load_local(self):
+        """Restores the catalog saved by the last successful sync, returns the snapshot or None."""
+        if not self.snapshot_path:
+            return None
+
+        loaded = load_snapshot(self.snapshot_path)
+        if loaded is None:
+            return None
+
+        version, header, records = loaded
+        self.digest = version #an unchanged sheet is then skipped by the first sync
+        self.header = header
+        self.records = records
+        self.snapshot = CatalogSnapshot.from_records(version, header, records)
+
+        return self.snapshot
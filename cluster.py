@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import multiprocessing
+import signal
+from queue import Full
+
+from telegram import Bot, Update
+from telegram.ext import Updater
+
+from update_processing import update_chat_key
+
+
+logger = logging.getLogger(__name__)
+
+#updates the ingress may queue for a busy worker before it waits, so a stuck worker can not eat all the memory
+WORKER_QUEUE_SIZE = 10000
+
+
+
+def shard_of_chat(chat_id, workers: int) -> int:
+    """Worker serving the chat, also used to load only that worker's share of the persisted state."""
+    return 0 if chat_id is None else chat_id % workers #group chat ids are negative, python's % still gives 0..workers-1
+
+
+def shard_of(update, workers: int) -> int:
+    return shard_of_chat(update_chat_key(update), workers)
+
+
+async def serve_worker(application, queue):
+    """Feeds the updates from the ingress queue to the application until the None sent on shutdown."""
+    while True:
+        data = await asyncio.to_thread(queue.get)
+        if data is None:
+            return
+        await application.update_queue.put(Update.de_json(data, application.bot))
+
+
+async def run_worker_async(index: int, workers: int, queue, bot_api_url=None):
+    from main import METRICS_PORT, build_application, post_init, post_shutdown
+
+    application = build_application(base_url=bot_api_url, with_updater=False, sync_catalog=index == 0, worker_index=index,
+                                    workers=workers, metrics_port=METRICS_PORT + index if METRICS_PORT else 0)
+    #the ingress owns the signals, a worker stops when it receives the None
+    async with application:
+        await post_init(application) #run_polling/run_webhook call these themselves, here nobody else does
+        await application.start()
+        logger.info('Worker %s/%s started', index, workers)
+        try:
+            await serve_worker(application, queue)
+        finally:
+            await application.stop()
+    await post_shutdown(application)
+    logger.info('Worker %s/%s stopped', index, workers)
+
+
+def run_worker(index: int, workers: int, queue, bot_api_url=None):
+    #heroku and a ctrl+c in the terminal signal every process of the group, a worker that died on them would skip
+    #application.stop() and lose the unflushed persistence and caches; it stops on the None of the ingress instead
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(run_worker_async(index, workers, queue, bot_api_url))
+
+
+def start_workers(workers: int, target=run_worker, args=()):
+    """Starts the worker processes, returns them and their input queues."""
+    context = multiprocessing.get_context('spawn') #a fresh interpreter, nothing of the parent's state is inherited
+    queues = [context.Queue(WORKER_QUEUE_SIZE) for _ in range(workers)]
+    processes = [context.Process(target=target, args=(index, workers, queues[index], *args), name=f'bot-worker-{index}')
+                 for index in range(workers)]
+    for process in processes:
+        process.start()
+
+    return processes, queues
+
+
+def stop_workers(processes, queues, timeout=30):
+    for queue in queues:
+        queue.put(None)
+    for process in processes:
+        process.join(timeout)
+        if process.is_alive():
+            logger.warning('Worker %s did not stop in %ss, killing it', process.name, timeout)
+            process.kill() #the workers ignore SIGTERM
+
+
+async def run_ingress(token: str, queues: list, mode='polling', bot_api_url=None, webhook_kwargs=None):
+    #Bot's defaults are telegram's servers, None is not accepted for the urls
+    bot_kwargs = {'base_url': f'{bot_api_url}/bot', 'base_file_url': f'{bot_api_url}/file/bot'} if bot_api_url else {}
+    bot = Bot(token, **bot_kwargs)
+    update_queue = asyncio.Queue()
+    stop = asyncio.Event()
+
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    forwarded = [0] * len(queues)
+
+    async def forward(update):
+        shard = shard_of(update, len(queues))
+        data = update.to_dict()
+        try:
+            queues[shard].put_nowait(data)
+        except Full: #the worker is behind, wait for it off the event loop
+            await asyncio.to_thread(queues[shard].put, data)
+        forwarded[shard] += 1
+
+    async with Updater(bot, update_queue) as updater:
+        if mode == 'webhook':
+            await updater.start_webhook(**webhook_kwargs)
+        else:
+            await updater.start_polling(allowed_updates=Update.ALL_TYPES)
+        logger.info('Ingress started in %s mode with %s workers', mode, len(queues))
+
+        stop_task = asyncio.ensure_future(stop.wait())
+        while True:
+            get_task = asyncio.ensure_future(update_queue.get())
+            await asyncio.wait({get_task, stop_task}, return_when=asyncio.FIRST_COMPLETED)
+            if not get_task.done():
+                get_task.cancel()
+                break
+
+            await forward(get_task.result())
+
+        await updater.stop()
+        while not update_queue.empty(): #updates fetched before the updater stopped
+            await forward(update_queue.get_nowait())
+
+    logger.info('Ingress stopped, updates forwarded per worker: %s', forwarded)
+
+
+def run_cluster(token: str, workers: int, mode='polling', bot_api_url=None, webhook_kwargs=None):
+    """Multi-process mode: this process receives the updates, `workers` processes run the bot.
+
+    The ingress gets the updates from telegram (long polling or the webhook, through PTB's Updater) and forwards
+    each one to a worker chosen by chat id, so a conversation always stays on the same worker and its updates
+    keep their order. Every worker is a full Application without an updater: own event loop, handlers, job queue
+    and http clients, sharing the SQLite persistence file with the others.
+
+    Worker 0 syncs the google sheet and writes the catalog snapshot file, the other workers reload that file when
+    it changes (see main.reload_catalog), so the sheet is read once however many workers run.
+    """
+    processes, queues = start_workers(workers, args=(bot_api_url,))
+    try:
+        asyncio.run(run_ingress(token, queues, mode, bot_api_url, webhook_kwargs))
+    finally:
+        stop_workers(processes, queues)
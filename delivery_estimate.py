@@ -0,0 +1,118 @@
+import bisect
+import json
+import logging
+import math
+
+from local_files import save_json
+
+
+logger = logging.getLogger(__name__)
+
+
+#start point of the yandex requests (Каменоостровский, 61), (lat, lon)
+PICK_UP_COORDINATES = (59.9728, 30.3057)
+
+#distance rings around the pick-up point (km, upper bounds) and weight classes (kg, upper bounds) of the zone table
+DISTANCE_ZONES_KM = (3, 6, 10, 15, 20, 30, 45)
+WEIGHT_CLASSES_KG = (5, 20, 50, 300)
+
+#starting point of the table before any calibration: base price and price per km of each weight class, roughly the yandex tariffs in St. Petersburg
+DEFAULT_TARIFFS = ((350, 28), (450, 35), (900, 55), (1500, 75))
+
+
+
+def haversine_km(a: tuple, b: tuple) -> float:
+    lat1, lon1, lat2, lon2 = map(math.radians, (a[0], a[1], b[0], b[1]))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371.0 * math.asin(math.sqrt(h))
+
+
+def zone_midpoints() -> list:
+    bounds = (0,) + DISTANCE_ZONES_KM
+    return [(bounds[i] + bounds[i + 1]) / 2 for i in range(len(DISTANCE_ZONES_KM))]
+
+
+
+class DeliveryEstimator:
+    """Instant local delivery price: zone table (distance ring x weight class) around the pick-up point.
+
+    Every live quote passed to observe() pulls its cell towards the real price (exponential moving average),
+    so the table calibrates itself from past quotes. With a path the calibrated table survives restarts.
+    """
+
+    def __init__(self, origin=PICK_UP_COORDINATES, alpha=0.2, path=None):
+        self.origin = origin
+        self.alpha = alpha
+        self.path = path
+
+        midpoints = zone_midpoints()
+        #table[zone][weight class] -> rubles
+        self.table = [[base + per_km * km for base, per_km in DEFAULT_TARIFFS] for km in midpoints]
+        self.samples = [[0] * len(WEIGHT_CLASSES_KG) for _ in midpoints]
+
+
+    def _cell(self, destination: tuple, weight: float):
+        distance = haversine_km(self.origin, destination)
+        zone = bisect.bisect_left(DISTANCE_ZONES_KM, distance)
+        weight_class = min(bisect.bisect_left(WEIGHT_CLASSES_KG, weight), len(WEIGHT_CLASSES_KG) - 1)
+        return distance, zone, weight_class
+
+
+    def estimate(self, destination: tuple, weight: float) -> float:
+        """Estimated price in rubles for a (lat, lon) destination, rounded to 10 rubles."""
+        distance, zone, weight_class = self._cell(destination, weight)
+
+        if zone < len(DISTANCE_ZONES_KM):
+            price = self.table[zone][weight_class]
+        else: #outside the table, continue the last ring with the per km tariff of the weight class
+            price = self.table[-1][weight_class] + DEFAULT_TARIFFS[weight_class][1] * (distance - zone_midpoints()[-1])
+
+        return round(price, -1)
+
+
+    def observe(self, destination: tuple, weight: float, price: float):
+        distance, zone, weight_class = self._cell(destination, weight)
+        if zone >= len(DISTANCE_ZONES_KM):
+            return
+
+        #the first quotes of a cell move it faster than the later ones
+        alpha = max(self.alpha, 1 / (self.samples[zone][weight_class] + 1))
+        self.table[zone][weight_class] += alpha * (price - self.table[zone][weight_class])
+        self.samples[zone][weight_class] += 1
+
+
+    def load(self):
+        if not self.path:
+            return
+
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning('Could not read the delivery estimator table %s: %s', self.path, e)
+            return
+
+        if data.get('zones') != list(DISTANCE_ZONES_KM) or data.get('weights') != list(WEIGHT_CLASSES_KG):
+            logger.warning('Ignoring the delivery estimator table %s built for other zones', self.path)
+            return
+
+        self.table = data['table']
+        self.samples = data['samples']
+
+
+    def dump(self) -> dict:
+        return {'zones': list(DISTANCE_ZONES_KM), 'weights': list(WEIGHT_CLASSES_KG),
+                'table': [list(row) for row in self.table], 'samples': [list(row) for row in self.samples]}
+
+
+    def save(self, data: dict = None):
+        """Writes the table to self.path; pass the data taken by dump() to write it from another thread."""
+        if not self.path:
+            return
+
+        if data is None:
+            data = self.dump()
+
+        save_json(self.path, data)
@@ -0,0 +1,177 @@
+import bisect
+import functools
+import logging
+import time
+from collections import OrderedDict
+
+from telegram.ext import ConversationHandler
+
+from update_processing import iter_conversation_handlers, update_chat_key
+
+
+logger = logging.getLogger(__name__)
+
+#seconds a user spent in a state before the next answer
+DWELL_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 900, 3600)
+
+NOT_STARTED = 'NOT_STARTED'
+ENDED = 'END'
+
+
+
+class FunnelTracker:
+    """Where the users of the order conversation are and where they drop off.
+
+    Every conversation callback is wrapped by instrument(): the state it returns is the user's new state, so the
+    current state of a chat is a dict lookup and no handler internals are scanned. Aggregates since start:
+    - entered[state]: how many times users got into each state
+    - transitions[(from, to)]: the edges of the funnel
+    - dwell[state]: histogram (DWELL_BUCKETS) of the time spent in a state before moving on
+    - completed: conversations that reached a final state (START_PAYMENT), ended[state]: conversations ended
+      (/end, cancel) from a state, abandoned[state]: chats that went idle for idle_timeout in a state
+
+    Chats are kept in least recently active order; idle ones are expired by expire() and the oldest is evicted
+    (and counted as abandoned) when more than max_chats are tracked, so memory is bounded.
+    """
+
+    def __init__(self, state_names, final_states=(), idle_timeout=3600, max_chats=100000):
+        self.state_names = tuple(state_names)
+        self.final_states = set(final_states)
+        self.idle_timeout = idle_timeout
+        self.max_chats = max_chats
+
+        self._chats = OrderedDict() #chat id -> (state, entered at), least recently active first
+
+        names = self.state_names
+        self.entered = dict.fromkeys(names, 0)
+        self.ended = dict.fromkeys(names, 0)
+        self.abandoned = dict.fromkeys(names, 0)
+        self.dwell = {name: [0] * (len(DWELL_BUCKETS) + 1) for name in names}
+        self.dwell_sum = dict.fromkeys(names, 0.0)
+        self.transitions = {}
+        self.completed = 0
+
+
+    def state_name(self, state) -> str:
+        if state is None:
+            return NOT_STARTED
+        if state == ConversationHandler.END:
+            return ENDED
+        return self.state_names[state]
+
+
+    def current_state(self, chat_id):
+        """State of the chat's conversation (an int as returned by the handlers) or None."""
+        entry = self._chats.get(chat_id)
+        return entry[0] if entry is not None else None
+
+
+    def transition(self, chat_id, new_state, now=None):
+        """Records the state a callback returned; None keeps the state, like in ConversationHandler."""
+        if new_state is None or chat_id is None:
+            return
+        now = time.monotonic() if now is None else now
+
+        entry = self._chats.pop(chat_id, None)
+        old_state = None
+        if entry is not None:
+            old_state, entered_at = entry
+            old_name = self.state_names[old_state]
+            elapsed = now - entered_at
+            self.dwell[old_name][bisect.bisect_left(DWELL_BUCKETS, elapsed)] += 1
+            self.dwell_sum[old_name] += elapsed
+
+        edge = (self.state_name(old_state), self.state_name(new_state))
+        self.transitions[edge] = self.transitions.get(edge, 0) + 1
+        logger.debug('Chat %s: %s -> %s', chat_id, *edge)
+
+        if new_state == ConversationHandler.END:
+            if old_state is not None:
+                self.ended[self.state_names[old_state]] += 1
+            return
+
+        self.entered[self.state_names[new_state]] += 1
+        if new_state in self.final_states:
+            self.completed += 1
+            return
+
+        self._chats[chat_id] = (new_state, now)
+        if len(self._chats) > self.max_chats:
+            self._abandon(*self._chats.popitem(last=False))
+
+
+    def _abandon(self, chat_id, entry):
+        self.abandoned[self.state_names[entry[0]]] += 1
+
+
+    def expire(self, now=None) -> int:
+        """Counts the chats idle for idle_timeout as abandoned in their state and forgets them."""
+        now = time.monotonic() if now is None else now
+        expired = 0
+        while self._chats:
+            chat_id, entry = next(iter(self._chats.items()))
+            if now - entry[1] < self.idle_timeout:
+                break
+            self._abandon(*self._chats.popitem(last=False))
+            expired += 1
+
+        return expired
+
+
+    def instrument(self, callback):
+        @functools.wraps(callback)
+        async def wrapper(update, context, *args, **kwargs):
+            new_state = await callback(update, context, *args, **kwargs)
+            self.transition(update_chat_key(update), new_state)
+            return new_state
+
+        return wrapper
+
+
+    def instrument_conversation(self, conv_handler):
+        for _, handler in iter_conversation_handlers(conv_handler):
+            handler.callback = self.instrument(handler.callback)
+
+
+    def in_progress(self) -> dict:
+        """Number of tracked chats per current state, O(tracked chats): for reports, not for the update path."""
+        counts = dict.fromkeys(self.state_names, 0)
+        for state, _ in self._chats.values():
+            counts[self.state_names[state]] += 1
+        return counts
+
+
+    def summary(self) -> dict:
+        return {'tracked': len(self._chats), 'completed': self.completed,
+                'entered': {k: v for k, v in self.entered.items() if v},
+                'ended': {k: v for k, v in self.ended.items() if v},
+                'abandoned': {k: v for k, v in self.abandoned.items() if v}}
+
+
+    def prometheus_lines(self) -> list:
+        """The funnel in the Prometheus text format, for metrics.register_collector."""
+        lines = ['# HELP rentatool_funnel_entered_total Times users entered a conversation state',
+                 '# TYPE rentatool_funnel_entered_total counter']
+        lines += [f'rentatool_funnel_entered_total{{state="{name}"}} {value}' for name, value in self.entered.items()]
+        lines += ['# HELP rentatool_funnel_abandoned_total Conversations that went idle in a state',
+                  '# TYPE rentatool_funnel_abandoned_total counter']
+        lines += [f'rentatool_funnel_abandoned_total{{state="{name}"}} {value}' for name, value in self.abandoned.items()]
+        lines += ['# HELP rentatool_funnel_ended_total Conversations ended by the user from a state',
+                  '# TYPE rentatool_funnel_ended_total counter']
+        lines += [f'rentatool_funnel_ended_total{{state="{name}"}} {value}' for name, value in self.ended.items()]
+        lines += ['# HELP rentatool_funnel_completed_total Conversations that reached a final state',
+                  '# TYPE rentatool_funnel_completed_total counter', f'rentatool_funnel_completed_total {self.completed}']
+        lines += ['# HELP rentatool_funnel_in_progress Open conversations', '# TYPE rentatool_funnel_in_progress gauge',
+                  f'rentatool_funnel_in_progress {len(self._chats)}']
+
+        lines += ['# HELP rentatool_state_dwell_seconds Time users spent in a state before their next answer',
+                  '# TYPE rentatool_state_dwell_seconds histogram']
+        for name, counts in self.dwell.items():
+            cumulative = 0
+            for bound, count in zip(DWELL_BUCKETS + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'rentatool_state_dwell_seconds_bucket{{state="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'rentatool_state_dwell_seconds_sum{{state="{name}"}} {self.dwell_sum[name]}')
+            lines.append(f'rentatool_state_dwell_seconds_count{{state="{name}"}} {cumulative}')
+
+        return lines
@@ -1,26 +1,76 @@
-import requests
-from config import GEOCODER_API_KEY
-
-
-def get_coordinates(address: str):
-    url = "https://geocode-maps.yandex.ru/v1"
-    params = {
-        "apikey": GEOCODER_API_KEY,
-        "format": "json",
-        "geocode": address
-    }
-    
-    response = requests.get(url, params=params)
-    response.raise_for_status()
-    data = response.json()
-
-
-    try:
-        pos = (
-            data["response"]["GeoObjectCollection"]["featureMember"][0]["GeoObject"]["Point"]["pos"]
-        )
-        lon, lat = pos.split(" ")
-        return float(lat), float(lon)  # (lat, lon) order
-    except (KeyError, IndexError):
-        return None
-
+import asyncio
+
+import httpx
+from config import GEOCODER_API_KEY
+
+from resilience import CircuitBreaker, call_upstream
+
+
+GEOCODER_URL = "https://geocode-maps.yandex.ru/v1"
+GEOCODER_TIMEOUT = httpx.Timeout(5.0, connect=3.0)
+GEOCODER_LIMITS = httpx.Limits(max_connections=10, max_keepalive_connections=5, keepalive_expiry=60.0)
+#whole lookup including retries, geocoding is a GET so it is safe to retry and to hedge
+GEOCODER_DEADLINE = 6.0
+GEOCODER_RETRIES = 2
+GEOCODER_HEDGE_AFTER = None #seconds, e.g. 1.0 to send a second request when the first one is slow
+
+geocoder_breaker = CircuitBreaker('geocoder', failure_threshold=5, cooldown=30.0)
+
+#shared by all the coroutines of the bot, created on first use and closed by aclose_geocoder_client on shutdown
+_client = None
+
+
+def get_geocoder_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(timeout=GEOCODER_TIMEOUT, limits=GEOCODER_LIMITS)
+
+    return _client
+
+
+async def aclose_geocoder_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def parse_coordinates(data: dict):
+    try:
+        pos = (
+            data["response"]["GeoObjectCollection"]["featureMember"][0]["GeoObject"]["Point"]["pos"]
+        )
+        lon, lat = pos.split(" ")
+        return float(lat), float(lon)  # (lat, lon) order
+    except (KeyError, IndexError):
+        return None
+
+
+async def get_coordinates_async(address: str, client: httpx.AsyncClient = None, breaker: CircuitBreaker = geocoder_breaker):
+    """(lat, lon) of the address or None if the geocoder does not know it, raises resilience.UpstreamError when the geocoder fails."""
+    params = {
+        "apikey": GEOCODER_API_KEY,
+        "format": "json",
+        "geocode": address
+    }
+
+    client = client if client is not None else get_geocoder_client()
+
+    async def request():
+        response = await client.get(GEOCODER_URL, params=params)
+        response.raise_for_status()
+        return response.json()
+
+    data = await call_upstream('geocoder', request, breaker=breaker, deadline=GEOCODER_DEADLINE,
+                               retries=GEOCODER_RETRIES, hedge_after=GEOCODER_HEDGE_AFTER, operation='geocode')
+
+    return parse_coordinates(data)
+
+
+def get_coordinates(address: str):
+    """Blocking version for scripts, never call it from the bot's event loop."""
+    async def run():
+        async with httpx.AsyncClient(timeout=GEOCODER_TIMEOUT) as client:
+            return await get_coordinates_async(address, client=client, breaker=None)
+
+    return asyncio.run(run())
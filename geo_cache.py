@@ -0,0 +1,127 @@
+import asyncio
+import json
+import logging
+import re
+import time
+
+from cachetools import TTLCache
+
+from geo import get_coordinates_async
+from local_files import save_json
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CITY = 'Санкт-Петербург'
+
+#the default street type is dropped so that "ул. Есенина" and "Есенина" share a key, other types (проспект, переулок...) are kept
+_STREET_PREFIX = re.compile(r'^(ул\.?|улица)\s+')
+_STREET_SUFFIX = re.compile(r'\s+(ул\.?|улица)$')
+_BUILDING_PREFIX = re.compile(r'^(д\.?|дом)\s*')
+
+
+
+def _normalize_part(part: str) -> str:
+    return ' '.join(part.lower().replace('ё', 'е').split())
+
+
+def normalize_address(address: str, city: str = DEFAULT_CITY) -> tuple:
+    """Turns 'Есенина, 20, 29' into ('санкт-петербург', 'есенина', '20').
+
+    Only the street and the building matter for the coordinates, the apartment and anything after it is dropped.
+    """
+    parts = [_normalize_part(part) for part in str(address).split(',')]
+    parts = [part for part in parts if part]
+    if len(parts) < 2:
+        raise ValueError(f'Address {address!r} has no building number')
+
+    street = _STREET_SUFFIX.sub('', _STREET_PREFIX.sub('', parts[0]))
+    building = _BUILDING_PREFIX.sub('', parts[1]).replace(' ', '')
+
+    return _normalize_part(city), street, building
+
+
+
+class GeocodeCache:
+    """LRU + TTL cache in front of the geocoder, keyed on the normalized (city, street, building).
+
+    With a path the entries are written to a json file by save() and read back by load(), so the cache survives restarts.
+    Concurrent lookups of the same key share one geocoder request.
+    """
+
+    def __init__(self, maxsize=10000, ttl=30 * 24 * 3600, path=None, geocode=get_coordinates_async):
+        self.ttl = ttl
+        self.path = path
+        self.geocode = geocode
+        #wall clock timer, so the stored timestamps stay meaningful after a restart
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl, timer=time.time)
+        self._pending = {}
+
+        self.stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'not_found': 0}
+
+
+    async def get_coordinates(self, address: str, city: str = DEFAULT_CITY):
+        """Returns (lat, lon) of the address or None if the geocoder could not find it."""
+        key = normalize_address(address, city)
+
+        entry = self._cache.get(key)
+        if entry is not None and time.time() - entry[2] < self.ttl: #entries restored by load() keep their original age
+            self.stats['hits'] += 1
+            return entry[0], entry[1]
+
+        pending = self._pending.get(key)
+        if pending is not None: #somebody is already geocoding the same building
+            self.stats['coalesced'] += 1
+            return await asyncio.shield(pending)
+
+        self.stats['misses'] += 1
+        task = asyncio.ensure_future(self.geocode(', '.join(key)))
+        self._pending[key] = task
+        try:
+            coordinates = await asyncio.shield(task)
+        finally:
+            self._pending.pop(key, None)
+
+        if coordinates is None:
+            self.stats['not_found'] += 1
+        else:
+            self._cache[key] = (coordinates[0], coordinates[1], time.time())
+
+        return coordinates
+
+
+    def load(self):
+        if not self.path:
+            return
+
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning('Could not read the geocode cache %s: %s', self.path, e)
+            return
+
+        now = time.time()
+        for city, street, building, lat, lon, created_at in entries:
+            if now - created_at < self.ttl:
+                self._cache[(city, street, building)] = (lat, lon, created_at)
+
+        logger.info('Loaded %s geocode cache entries from %s', len(self._cache), self.path)
+
+
+    def dump(self) -> list:
+        self._cache.expire()
+        return [[*key, lat, lon, created_at] for key, (lat, lon, created_at) in self._cache.items()]
+
+
+    def save(self, entries: list = None):
+        """Writes the cache to self.path; pass entries taken by dump() to write them from another thread."""
+        if not self.path:
+            return
+
+        if entries is None:
+            entries = self.dump()
+
+        save_json(self.path, entries)
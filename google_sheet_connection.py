@@ -1,28 +1,36 @@
-from googleapiclient.errors import HttpError
-from googleapiclient.discovery import build
-from google.oauth2 import service_account 
-import pandas as pd
+import threading
 
+from config import SCOPES, SERVICE_ACCOUNT_FILE, SAMPLE_RANGE, SAMPLE_SPREADSHEET_ID
 
+import metrics
 
-from config import SCOPES, SERVICE_ACCOUNT_FILE, SAMPLE_RANGE, SAMPLE_SPREADSHEET_ID
+
+#the credentials and the discovery client are expensive to build, so we keep one per (scopes, json file) pair
+_services = {}
+#httplib2 (used under the hood by googleapiclient) is not thread safe, so only one worker thread talks to google at a time
+_service_lock = threading.Lock()
 
 
+def get_sheets_service(scopes: list, service_account_json: str):
+    key = (tuple(scopes), service_account_json)
+    service = _services.get(key)
+    if service is None:
+        #imported here, it is only needed by the refresh worker and would add its load time to the bot startup
+        from googleapiclient.discovery import build
+        from google.oauth2 import service_account
 
-def get_table_gsh(scopes: list, service_account_json: str, sheet_range: str, spreadsheet_id: str)-> pd.DataFrame:
-    credentials = None
-    credentials = service_account.Credentials.from_service_account_file(service_account_json, scopes=scopes)
+        credentials = service_account.Credentials.from_service_account_file(service_account_json, scopes=scopes)
+        service = build('sheets', 'v4', credentials=credentials, cache_discovery=False)
+        _services[key] = service
 
+    return service
 
-    service = build('sheets', 'v4', credentials=credentials)
-    sheet = service.spreadsheets()
-    #Fetch values from the sheet
-    result = sheet.values().get(spreadsheetId=spreadsheet_id, range=sheet_range).execute()
-    values = result.get('values', [])
 
-    df = pd.DataFrame(values)
-    df.columns = df.iloc[0]
-    df = df.drop(0, axis=0).reset_index(drop=True)
+def get_values_gsh(scopes: list, service_account_json: str, sheet_range: str, spreadsheet_id: str) -> list:
+    with _service_lock, metrics.track(metrics.UPSTREAM_SECONDS, 'google_sheets', 'values.get', errors=metrics.UPSTREAM_ERRORS):
+        sheet = get_sheets_service(scopes, service_account_json).spreadsheets()
+        #Fetch values from the sheet
+        result = sheet.values().get(spreadsheetId=spreadsheet_id, range=sheet_range).execute()
 
-    return df
+    return result.get('values', [])
 
@@ -0,0 +1,15 @@
+import json
+import os
+
+
+
+def save_json(path: str, data):
+    """Writes data as json to path through a temporary file, so a crash in the middle never leaves a truncated file.
+
+    The local caches are written from a worker thread with data copied on the event loop (their dump()); every
+    process of the multi-process mode has its own files (main.worker_file), so one temporary name per file is enough.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
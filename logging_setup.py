@@ -0,0 +1,167 @@
+import atexit
+import contextvars
+import copy
+import functools
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import time
+
+from update_processing import iter_conversation_handlers, update_chat_key
+
+
+logger = logging.getLogger(__name__)
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(funcName)s - %(message)s'
+#record attributes written as json fields when set, pass them with extra={...} or let ContextFilter fill them in
+STRUCTURED_FIELDS = ('chat_id', 'state', 'latency')
+
+#chat and conversation state of the callback that is running, set by instrument_callback; every task has its own copy
+chat_id_var = contextvars.ContextVar('chat_id', default=None)
+state_var = contextvars.ContextVar('state', default=None)
+
+
+
+class ContextFilter(logging.Filter):
+    """Puts the chat_id and state of the update being handled on the records that do not have them."""
+
+    def filter(self, record):
+        if getattr(record, 'chat_id', None) is None:
+            record.chat_id = chat_id_var.get()
+        if getattr(record, 'state', None) is None:
+            record.state = state_var.get()
+        return True
+
+
+
+class SamplingFilter(logging.Filter):
+    """Lets only a share (rate) of the records at level or below through, more severe ones always pass."""
+
+    def __init__(self, rate=1.0, level=logging.DEBUG):
+        super().__init__()
+        self.rate = rate
+        self.level = level
+        self.dropped = 0
+
+
+    def filter(self, record):
+        if record.levelno > self.level or self.rate >= 1:
+            return True
+        if random.random() < self.rate:
+            return True
+        self.dropped += 1
+        return False
+
+
+
+class JsonFormatter(logging.Formatter):
+    """One json object per line: time, level, logger, function, message, STRUCTURED_FIELDS and the traceback."""
+
+    def format(self, record):
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name,
+                 'func': record.funcName, 'message': record.getMessage()}
+        for field in STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        if record.stack_info:
+            entry['stack'] = self.formatStack(record.stack_info)
+
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records when the queue is full instead of blocking the caller (the event loop)."""
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+
+    def prepare(self, record):
+        #the message is rendered here because the args may change once the call returns, the traceback is kept
+        #apart so that the json formatter can put it in its own field
+        record = copy.copy(record)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+
+def setup_logging(level=logging.INFO, json_format=True, debug_sample_rate=1.0, queue_size=10000, stream=None):
+    """Routes the records of all loggers through a queue to a background thread that writes them to stream (stdout).
+
+    Loggers only format the message and put the record on the queue, so a slow stdout never blocks a handler;
+    when the writer falls queue_size records behind new records are dropped. debug_sample_rate < 1 keeps
+    only that share of the debug records. Replaces the handlers of the root logger, returns the running
+    QueueListener (stopped and drained at exit).
+    """
+    stream_handler = logging.StreamHandler(stream or sys.stdout)
+    stream_handler.setFormatter(JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT))
+
+    log_queue = queue.Queue(maxsize=queue_size)
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(debug_sample_rate)) #first, a sampled out record costs nothing more
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    return listener
+
+
+def _state_name(state, state_names):
+    return state_names[state] if isinstance(state, int) and 0 <= state < len(state_names) else state
+
+
+def instrument_callback(callback, state=None, name=None, log=logger, state_names=()):
+    """Wraps an async handler callback: the records logged while it runs carry the chat_id and state, and one
+    debug record with its latency (seconds) and the returned state (its name from state_names) is logged when it returns."""
+    name = name or callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context, *args, **kwargs):
+        chat_token = chat_id_var.set(update_chat_key(update))
+        state_token = state_var.set(state)
+        started = time.perf_counter()
+        try:
+            new_state = await callback(update, context, *args, **kwargs)
+            log.debug('%s returned %s', name, _state_name(new_state, state_names), extra={'latency': round(time.perf_counter() - started, 6)})
+            return new_state
+        finally:
+            chat_id_var.reset(chat_token)
+            state_var.reset(state_token)
+
+    return wrapper
+
+
+def instrument_conversation(conv_handler, state_names=(), log=logger):
+    """Wraps the callbacks of a ConversationHandler, the ones of a state are logged with state_names[state] to log."""
+    for state, handler in iter_conversation_handlers(conv_handler):
+        handler.callback = instrument_callback(handler.callback, _state_name(state, state_names), log=log, state_names=state_names)
@@ -1,155 +1,365 @@
+import time
+STARTUP_TIME = time.perf_counter() #taken before the heavy imports, used for the time-to-first-update log
+
+import argparse
+import asyncio
 import logging
-import traceback
-import sys
+import os
+import secrets
 import bisect
-import pandas as pd
-import numpy as np
-from tabulate import tabulate
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice
-from telegram.ext import Application, ContextTypes, CommandHandler, MessageHandler, filters, CallbackQueryHandler, JobQueue, ConversationHandler
+from telegram.ext import Application, ContextTypes, CommandHandler, MessageHandler, filters, CallbackQueryHandler, JobQueue, ConversationHandler, TypeHandler
 
 from config import YANDEX_TOKEN
 from yandex_delivery_test import YandexCargoClient
-
-from google_sheet_connection import get_table_gsh, SCOPES, SERVICE_ACCOUNT_FILE, SAMPLE_RANGE, SAMPLE_SPREADSHEET_ID
+from geo import aclose_geocoder_client
+from geo_cache import GeocodeCache, normalize_address
+from delivery_estimate import DeliveryEstimator
+from resilience import CircuitOpenError, UpstreamError
+from catalog_sync import CatalogSync
+from catalog import CatalogSnapshot
+from render_cache import RenderCache
+from session import get_session
+from update_processing import ChatOrderedUpdateProcessor
+from persistence import SQLitePersistence
+from rate_limit import TokenBucketRateLimiter
+from outbox import Outbox
+from photo_cache import PhotoCache
+from funnel import FunnelTracker
+import metrics
+import logging_setup
+
+from google_sheet_connection import get_values_gsh, SCOPES, SERVICE_ACCOUNT_FILE, SAMPLE_RANGE, SAMPLE_SPREADSHEET_ID
 
 from config import AGENT_PHONE_NUMBER, TOKEN, PAYMENT_PROVIDER_TOKEN, AVITO_LINK, PICK_UP_ADDRESS
 
 
 
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO)
+#all the records go through a queue to a writer thread, so a slow stdout does not stall the event loop (see logging_setup)
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+#'json' (one object per line with chat_id, state and latency when known) or 'text'
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+#share of the debug records that are written, e.g. 0.01 on a busy instance; info and above are always written
+LOG_DEBUG_SAMPLE_RATE = float(os.environ.get('LOG_DEBUG_SAMPLE_RATE', 1.0))
+
+logging_setup.setup_logging(LOG_LEVEL, json_format=LOG_FORMAT == 'json', debug_sample_rate=LOG_DEBUG_SAMPLE_RATE)
 
 logging.getLogger('httpx').setLevel(logging.WARNING)
 logging.getLogger('googleapiclient.discovery_cache').setLevel(logging.WARNING)
 
 
-#this module's logger
-main_logger = logging.getLogger(__name__)   
-main_logger.setLevel(logging.DEBUG)      
-main_logger.propagate = False
-
-formatter = logging.Formatter('%(name)s - %(levelname)s - %(funcName)s - %(message)s ')
-ch = logging.StreamHandler(sys.stdout)
-ch.setLevel(logging.DEBUG)
-ch.setFormatter(formatter)
-main_logger.addHandler(ch)
-
+#this module's logger, its level is LOG_LEVEL like the others (LOG_LEVEL=DEBUG shows the conversation steps)
+main_logger = logging.getLogger(__name__)
+
+
+#how often the sheet is polled, unchanged sheets only cost the download (see CatalogSync)
+GSH_REFRESH_INTERVAL = 15
+#multi-process mode: how often the workers that do not sync the sheet look for a new snapshot file
+CATALOG_RELOAD_INTERVAL = 2
+#last successfully synced catalog, loaded at startup so the bot can serve before google answers
+CATALOG_SNAPSHOT_FILE = os.environ.get('CATALOG_SNAPSHOT_FILE', 'catalog_snapshot.bin')
+#geocoded buildings, kept across restarts
+GEOCODE_CACHE_FILE = os.environ.get('GEOCODE_CACHE_FILE', 'geocode_cache.json')
+GEOCODE_CACHE_SIZE = int(os.environ.get('GEOCODE_CACHE_SIZE', 10000))
+GEOCODE_CACHE_TTL = int(os.environ.get('GEOCODE_CACHE_TTL', 30 * 24 * 3600))
+#telegram file_ids of the tool photos; with a chat id (e.g. a private service channel) the bot uploads all the
+#photos there after every catalog change, so no user waits for a first upload
+PHOTO_CACHE_FILE = os.environ.get('PHOTO_CACHE_FILE', 'photo_cache.json')
+PHOTO_PREWARM_CHAT_ID = os.environ.get('PHOTO_PREWARM_CHAT_ID')
+#zone table of the local delivery estimate, calibrated from the live quotes
+DELIVERY_ESTIMATOR_FILE = os.environ.get('DELIVERY_ESTIMATOR_FILE', 'delivery_estimator.json')
+#connection pool and quote cache lifetime of the application wide yandex client (see yandex_delivery_test.create_http_client)
+YANDEX_HTTP_SETTINGS = {
+    'max_connections': int(os.environ.get('YANDEX_MAX_CONNECTIONS', 20)),
+    'max_keepalive_connections': int(os.environ.get('YANDEX_MAX_KEEPALIVE_CONNECTIONS', 10)),
+    'connect_timeout': float(os.environ.get('YANDEX_CONNECT_TIMEOUT', 3.0)),
+    'read_timeout': float(os.environ.get('YANDEX_READ_TIMEOUT', 10.0)),
+    'quote_ttl': float(os.environ.get('YANDEX_QUOTE_TTL', 300)),
+    'deadline': float(os.environ.get('YANDEX_DEADLINE', 8.0)),
+    'retries': int(os.environ.get('YANDEX_RETRIES', 2)),
+}
+#handlers running at the same time for different chats, updates of one chat are still handled in order (1 = sequential)
+MAX_CONCURRENT_UPDATES = int(os.environ.get('MAX_CONCURRENT_UPDATES', 64))
+#open conversations and order sessions, so a restart does not drop the orders in progress ('' turns persistence off)
+PERSISTENCE_FILE = os.environ.get('PERSISTENCE_FILE', 'bot_state.sqlite3')
+PERSISTENCE_INTERVAL = float(os.environ.get('PERSISTENCE_INTERVAL', 5))
+#prometheus metrics on http://127.0.0.1:METRICS_PORT/metrics, 0 turns the instrumentation off (worker i of the multi-process mode uses METRICS_PORT + i)
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))
+#a conversation without an answer for this long counts as abandoned in its state (see FunnelTracker)
+FUNNEL_IDLE_TIMEOUT = int(os.environ.get('FUNNEL_IDLE_TIMEOUT', 3600))
+
+WRONG_ADDRESS_TEXT = 'Ваш адрес указан в неверном формате или Яндекс Доставка не распознает ваш адрес, попробуйте ввести другой адрес.\n Если вы хотите вернуться к выбору опции получения инструмента, выберите /back_to_delivery_choice из меню команд'
+
+DELIVERY_UNAVAILABLE_TEXT = 'Просим прощения, сервис доставки временно недоступен. Попробуйте ввести адрес еще раз через пару минут или выберите самовывоз командой /back_to_delivery_choice'
 
 INFO, TOOLS_SELECTION, CHOICE_PRICE_OR_DETAILS, SHOW_PRICES_OR_DETAILS, PRICES, ORDERING, CONCLUDE_ORDER, DELIVERY_QUESTION, DELIVERY_CHOICE, DELIVERY_DETAILS, CONFIRM_ORDER, PICK_UP_CONFIRM, GET_PERSONAL_DETAILS, START_PAYMENT = range(14)
+STATE_NAMES = ('INFO', 'TOOLS_SELECTION', 'CHOICE_PRICE_OR_DETAILS', 'SHOW_PRICES_OR_DETAILS', 'PRICES', 'ORDERING', 'CONCLUDE_ORDER', 'DELIVERY_QUESTION', 'DELIVERY_CHOICE', 'DELIVERY_DETAILS', 'CONFIRM_ORDER', 'PICK_UP_CONFIRM', 'GET_PERSONAL_DETAILS', 'START_PAYMENT')
 
 
 """
 SUPPORT FUNCTIONS
 """
+def fetch_gsh_values() -> list:
+    return get_values_gsh(SCOPES, SERVICE_ACCOUNT_FILE, SAMPLE_RANGE, SAMPLE_SPREADSHEET_ID)
+
+
+def publish_catalog(bot_data: dict, snapshot: CatalogSnapshot):
+    bot_data["catalog"] = snapshot
+    bot_data["render_cache"].reset(snapshot.version)
+    photo_cache = bot_data.get('photo_cache')
+    if photo_cache is not None:
+        photo_cache.prune(snapshot)
+
+
 async def refresh_gsh(context: ContextTypes.DEFAULT_TYPE):
-    df = get_table_gsh(SCOPES, SERVICE_ACCOUNT_FILE, SAMPLE_RANGE, SAMPLE_SPREADSHEET_ID)
-    clean_df = preclean_full_df(df)
-    context.bot_data["full_tools_df"] = clean_df
+    catalog_sync = context.bot_data['catalog_sync']
+
+    #the catalog is fully built off the event loop, handlers keep using the previous one until publish_catalog swaps it
+    snapshot = await asyncio.to_thread(catalog_sync.sync)
+    if snapshot is None: #the sheet did not change since the last refresh
+        return
+
+    publish_catalog(context.bot_data, snapshot)
+    main_logger.debug('Published new catalog, sync stats: %s', catalog_sync.stats)
+
+    if PHOTO_PREWARM_CHAT_ID:
+        context.job_queue.run_once(prewarm_photos, 0)
+
+
+async def prewarm_photos(context: ContextTypes.DEFAULT_TYPE):
+    photo_cache = context.bot_data['photo_cache']
+    await photo_cache.prewarm(context.bot, PHOTO_PREWARM_CHAT_ID, context.bot_data['catalog'])
+    main_logger.debug('Photos pre-warmed, photo cache stats: %s', photo_cache.stats)
+    #written right away, the other workers of the multi-process mode pick the file_ids up from the file (share_photos)
+    await asyncio.to_thread(photo_cache.save, photo_cache.dump())
+
+
+async def share_photos(context: ContextTypes.DEFAULT_TYPE):
+    """Multi-process mode: adds the photo file_ids saved by the worker that syncs the sheet (and pre-warms the photos)."""
+    path = worker_file(PHOTO_CACHE_FILE, 0)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return
+
+    if mtime == context.bot_data.get('shared_photos_mtime'):
+        return
+    context.bot_data['shared_photos_mtime'] = mtime
+
+    entries = await asyncio.to_thread(PhotoCache.read, path)
+    if entries:
+        added = context.bot_data['photo_cache'].merge(entries)
+        main_logger.debug('Added %s photo file ids of worker 0', added)
+
+
+async def reload_catalog(context: ContextTypes.DEFAULT_TYPE):
+    """Multi-process mode: picks up the snapshot file written by the worker that syncs the sheet."""
+    catalog_sync = context.bot_data['catalog_sync']
+    try:
+        mtime = os.stat(catalog_sync.snapshot_path).st_mtime_ns
+    except OSError: #not written yet
+        return
+
+    if mtime == context.bot_data.get('catalog_mtime'):
+        return
+    context.bot_data['catalog_mtime'] = mtime
+
+    snapshot = await asyncio.to_thread(catalog_sync.load_local)
+    catalog = context.bot_data.get('catalog')
+    if snapshot is not None and (catalog is None or snapshot.version != catalog.version):
+        publish_catalog(context.bot_data, snapshot)
+        main_logger.debug('Reloaded catalog snapshot %s', snapshot.version)
+
+
+async def expire_funnel(context: ContextTypes.DEFAULT_TYPE):
+    funnel = context.bot_data['funnel']
+    if funnel.expire():
+        main_logger.debug('Conversation funnel: %s', funnel.summary())
+
+
+async def save_local_caches(context: ContextTypes.DEFAULT_TYPE):
+    geocode_cache = context.bot_data['geocode_cache']
+    #the entries are copied on the event loop, only the file write goes to the worker thread
+    await asyncio.to_thread(geocode_cache.save, geocode_cache.dump())
+    main_logger.debug('Saved geocode cache, stats: %s', geocode_cache.stats)
+
+    delivery_estimator = context.bot_data['delivery_estimator']
+    await asyncio.to_thread(delivery_estimator.save, delivery_estimator.dump())
+
+    photo_cache = context.bot_data['photo_cache']
+    if photo_cache.dirty:
+        await asyncio.to_thread(photo_cache.save, photo_cache.dump())
+
+
+def worker_file(path: str, worker_index=None) -> str:
+    """Local file of a worker of the multi-process mode: 'geocode_cache.json' -> 'geocode_cache.2.json' for worker 2.
+
+    Every worker keeps its own caches, so the processes never write the same file.
+    """
+    if not path or worker_index is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f'{root}.{worker_index}{ext}'
+
+
+async def post_init(application: Application):
+    worker_index = application.bot_data.get('worker_index')
+    geocode_cache = GeocodeCache(maxsize=GEOCODE_CACHE_SIZE, ttl=GEOCODE_CACHE_TTL, path=worker_file(GEOCODE_CACHE_FILE, worker_index))
+    geocode_cache.load()
+    application.bot_data['geocode_cache'] = geocode_cache
+    application.job_queue.run_repeating(save_local_caches, interval=600, first=600)
+
+    delivery_estimator = DeliveryEstimator(path=worker_file(DELIVERY_ESTIMATOR_FILE, worker_index))
+    delivery_estimator.load()
+    application.bot_data['delivery_estimator'] = delivery_estimator
+
+    photo_cache = PhotoCache(path=worker_file(PHOTO_CACHE_FILE, worker_index))
+    photo_cache.load()
+    catalog = application.bot_data.get('catalog')
+    if catalog is not None:
+        photo_cache.prune(catalog)
+    application.bot_data['photo_cache'] = photo_cache
+
+    #one yandex client (and connection pool) for the whole application instead of one per order
+    application.bot_data['yandex_client'] = YandexCargoClient(YANDEX_TOKEN, geocode_cache=geocode_cache, **YANDEX_HTTP_SETTINGS)
+
+
+async def post_shutdown(application: Application):
+    yandex_client = application.bot_data.get('yandex_client')
+    if yandex_client is not None:
+        await yandex_client.aclose()
+    await aclose_geocoder_client()
+
+    geocode_cache = application.bot_data.get('geocode_cache')
+    if geocode_cache is not None:
+        geocode_cache.save()
+
+    delivery_estimator = application.bot_data.get('delivery_estimator')
+    if delivery_estimator is not None:
+        delivery_estimator.save()
+
+    photo_cache = application.bot_data.get('photo_cache')
+    if photo_cache is not None and photo_cache.dirty:
+        photo_cache.save()
+
+    metrics_server = application.bot_data.get('metrics_server')
+    if metrics_server is not None:
+        metrics_server.shutdown()
+
+    if application.bot.rate_limiter is not None:
+        main_logger.info('Bot API send stats: %s', application.bot.rate_limiter.stats)
+
+    funnel = application.bot_data.get('funnel')
+    if funnel is not None:
+        main_logger.info('Conversation funnel: %s', funnel.summary())
+
+
+async def log_first_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if context.bot_data.get('first_update_logged'):
+        return
+
+    context.bot_data['first_update_logged'] = True
+    catalog = context.bot_data.get('catalog')
+    main_logger.info('First update received %.3fs after start, catalog version: %s', time.perf_counter() - STARTUP_TIME, catalog.version if catalog else None)
 
 
 async def error(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    print(f'{update.message} caused {context.error}')
-    traceback.print_exception(type(context.error), context.error, context.error.__traceback__)
+    main_logger.error('Update %s caused %r', getattr(update, 'update_id', update), context.error, exc_info=context.error)
 
 
-def get_tool_info(df, tool):
-    df_for_tool = df.query(f'Инструмент == "{tool}"')
-    unique_models = df_for_tool[['Бренд', 'Модель']].drop_duplicates()
-    full_models_list = []
-    for row in unique_models.iterrows():
-        brand = row[1]['Бренд']
-        model = row[1]['Модель']
-        try:
-            full_model = brand + ' ' + model
-            if model == '-' or model == '':
-                main_logger.debug(f'SEEMS LIKE {tool, brand} IS NOT PROPERLY DEFINED IN THE SHEET')
-                pass
-            else:
-                full_models_list.append(full_model)
-        except Exception as e:
-            main_logger.debug(f'BRAND + MODEL CONCATENTATION GOES WRONG! Exception: {e}')
-            pass
-    
-    return full_models_list
+def get_tool_info(catalog: CatalogSnapshot, tool):
+    return list(catalog.get_models(tool))
 
 
-def get_list_of_tools_from_df(full_df):
-    unique_tools = full_df['Инструмент'].unique()
-    #dict mapping numbers to tools
-    tool_dict = {i+1: tool for i, tool in enumerate(unique_tools)}
+def get_list_of_tools(catalog: CatalogSnapshot):
+    return catalog.tool_list_text, catalog.tool_dict
 
-    text = '\n'.join(f"{i}. {tool}" for i, tool in tool_dict.items())
 
-    return text, tool_dict
+def render_tools_message(catalog: CatalogSnapshot) -> str:
+    text, _ = get_list_of_tools(catalog)
+    return f'В настоящий момент доступны следующие виды инструмента: \n\n{text} \n\nПожалуйста укажите номер интересующего вас инструмента, чтобы увидеть доступные модели и прайс-лист'
 
 
-def preclean_full_df(df) -> pd.DataFrame: #function that removes the rows with no prices right away and adds the unique key Brand + Model
+def get_tools_message(bot_data: dict, session=None) -> str:
+    """Tool list of the current catalog, rendered once per catalog version.
 
-    price_cols = [col for col in df.columns if 'Стоимость ' in col]
-    df = df.replace('', np.nan)
-    clean_df = df.dropna(subset=price_cols)
-    clean_df = clean_df.reset_index(drop=True)
-    clean_df['model_index'] = clean_df['Бренд'] + ' ' + clean_df['Модель']
+    Built from bot_data['catalog'] on every call instead of being kept in bot_data, bot_data is not persisted
+    and conversations restored after a restart must still get the list. The version is recorded in the session
+    of the user the list is shown to, tool_models_show resolves the numbers only against that version.
+    """
+    catalog = bot_data['catalog']
+    if session is not None:
+        session.snapshot_version = catalog.version
+    return bot_data['render_cache'].get(catalog.version, ('tools',), lambda: render_tools_message(catalog))
 
-    return clean_df
 
+def render_models_message(catalog: CatalogSnapshot, tool):
+    models_list = get_tool_info(catalog, tool)
+    if len(models_list) == 0:
+        return None, None
 
-async def prices(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chosen_model = context.user_data['chosen_model']
-    full_df = context.bot_data['full_tools_df']
+    formated_models = '\n'.join(models_list)
+    text_to_show = f'Доступные модели для инструмента {tool}:\n{formated_models}\n'
 
-    specific_model_rows = full_df.query(f'model_index == "{chosen_model}"').drop_duplicates(subset=['Бренд', 'Модель'])   #THIS CAN POTENTIALLY CAUSE ISSUES IF THERE ARE MORE THAN 1 ROW WITH A SPECIFIC MODEL_INDEX IN OUR DF, WATCH OUT
+    buttons = []
+    for model in models_list:
+        model_button = [InlineKeyboardButton(text=model, callback_data=model + '__CALLBACK')]
+        buttons.append(model_button)
 
-    context.user_data['specific_model_row'] = specific_model_rows
+    go_back_button = [InlineKeyboardButton(text='Вернуться к выбору вида инструмента', callback_data='go_back_to_tool_selection')]
+    buttons.append(go_back_button)
 
-    price_cols = [col for col in full_df.columns if 'Стоимость' in col]
-    price_df = specific_model_rows[price_cols]
-    price_df.columns = [col.replace('Стоимость ', '') for col in price_df.columns]
-    price_t = price_df.T
+    return text_to_show, InlineKeyboardMarkup(buttons)
 
-    if price_t.empty:
-        return 'NO_PRICES_FOUND'
-    
-    context.user_data['prices_for_chosen_tool'] = price_t
+
+def render_price_message(catalog: CatalogSnapshot, chosen_model):
+    record = catalog.get_record(chosen_model)
+    if record is None or not record.prices:
+        return None
+
+    from tabulate import tabulate #rendered once per model and catalog version, so kept off the startup path
 
     headers = ["Срок", "Стоимость"]
-    table_str = tabulate(price_t, headers, tablefmt="outline")
+    table_str = tabulate(record.prices, headers, tablefmt="outline")
 
     message_header = f'Прайс-лист для инструмента {chosen_model}:\n\n'
     message_body = f"<pre>{table_str}</pre>\n\nПожалуйста, укажите желаемый срок аренды (в днях)"
-    message_to_show = message_header + message_body
 
-    return message_to_show
+    return message_header + message_body
 
 
+def calculate_rental_price(record, number_days) -> int:
+    limits = [1, 3, 7]
+    idx = bisect.bisect_left(limits, number_days)
+    price_per_day = record.prices[idx][1]
 
+    return int(price_per_day) * int(number_days)
 
-async def tool_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    df = context.bot_data['full_tools_df']
-    chosen_model = context.user_data['chosen_model']
-    specific_model_rows = df.query(f'model_index == "{chosen_model}"')
 
-    picture_url =  specific_model_rows['picture_url'].unique()[0]
-    text = specific_model_rows['detail_power'].unique()[0]
+async def prices(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chosen_model = get_session(context.user_data).model_key
+    catalog = context.bot_data['catalog']
+
+    message_to_show = context.bot_data['render_cache'].get(catalog.version, ('prices', chosen_model), lambda: render_price_message(catalog, chosen_model))
+    if message_to_show is None:
+        return 'NO_PRICES_FOUND'
+
+    return message_to_show
 
-    return picture_url, text
 
 
 
+async def tool_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    catalog = context.bot_data['catalog']
+    chosen_model = get_session(context.user_data).model_key
+    record = catalog.get_record(chosen_model)
 
-def show_last_state(context: ContextTypes.DEFAULT_TYPE, logger=main_logger, next_state="MISSING"):
-    conv_handler_instance = context.bot_data["conv_handler"]
-    convos = conv_handler_instance._conversations
+    if record is None:
+        return None, None
 
-    state_num = list(convos.values())[0]
-    state_name = STATE_NAMES[state_num]
+    return record.picture_url, record.details
 
-    logger.debug(f'Returning {next_state} state')
-    logger.debug(f'Previous State is {state_name}')
-    
 
 
 
@@ -181,17 +391,17 @@ async def conversation_start(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def tool_types_show(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     callback_data = update.callback_query.data
-    main_logger.debug(f'callback_data in tool_types_show func is: {callback_data}')
+    main_logger.debug('callback_data in tool_types_show func is: %s', callback_data)
 
     if (callback_data == 'tools_show') or (callback_data == 'go_back_to_tool_selection'):
-        full_df = context.bot_data['full_tools_df'] 
-        text, tool_dict = get_list_of_tools_from_df(full_df)
-        context.bot_data['tool_dict_current'] = tool_dict
+        catalog = context.bot_data.get('catalog')
+        if catalog is None: #first start without a local snapshot and google did not answer yet
+            await update.callback_query.edit_message_text('Каталог инструментов загружается, пожалуйста, попробуйте через минуту с команды /start')
 
-        text_to_show = f'В настоящий момент доступны следующие виды инструмента: \n\n{text} \n\nПожалуйста укажите номер интересующего вас инструмента, чтобы увидеть доступные модели и прайс-лист'
+            main_logger.debug('Ending the conversation')
+            return ConversationHandler.END
 
-        context.bot_data['list_of_tools_text'] = text_to_show
-        context.user_data['tools_shown_flag'] = True
+        text_to_show = get_tools_message(context.bot_data, get_session(context.user_data))
         
         await update.callback_query.edit_message_text(text_to_show)
 
@@ -214,22 +424,28 @@ async def tool_types_show(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def tool_models_show(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
-    if context.user_data.get('tools_shown_flag'):
+    session = get_session(context.user_data)
+
+    if session.snapshot_version is not None: #the tool list was shown to this user
+        catalog = context.bot_data["catalog"]
+        if update.message is not None and session.snapshot_version != catalog.version:
+            #the catalog changed since the user got the list, the number may belong to another tool now
+            text_to_show = 'Список инструментов обновился, пожалуйста, укажите номер инструмента по новому списку:\n\n' + get_tools_message(context.bot_data, session)
+            await update.message.reply_text(text_to_show)
+
+            main_logger.debug('returning TOOLS_SELECTION state')
+            return TOOLS_SELECTION
+
         try:
             tool_num = update.message.text
-            tool = context.bot_data['tool_dict_current'][int(tool_num)]
-            context.user_data['chosen_tool'] = tool
+            tool = catalog.tool_dict[int(tool_num)]
+            session.tool = tool
         except:
-            tool = context.user_data['chosen_tool']
+            tool = session.tool
 
-        full_df = context.bot_data["full_tools_df"]
-        models_list = get_tool_info(full_df, tool)
+        text_to_show, dynamic_keyboard = context.bot_data['render_cache'].get(catalog.version, ('models', tool), lambda: render_models_message(catalog, tool))
 
-        if len(models_list) > 0:
-            formated_models = '\n'.join(models_list)
-            text_to_show = f'Доступные модели для инструмента {tool}:\n{formated_models}\n'
-        
-        else:
+        if text_to_show is None:
             await update.message.reply_text(f'Приносим свои извинения, список моделей для инструмента {tool} неполон. Для заказа этого инструмента, пожалуйста, проконсультируйтесь с нашим агентом:\n{AGENT_PHONE_NUMBER}\n' + 
                                             'Или укажите номер другого инструмента')
             
@@ -238,17 +454,6 @@ async def tool_models_show(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
             return TOOLS_SELECTION
 
-        buttons = []
-        for model in models_list:
-            model_button = [InlineKeyboardButton(text=model, callback_data=model + '__CALLBACK')]
-            buttons.append(model_button)
-        
-        go_back_button = [InlineKeyboardButton(text='Вернуться к выбору вида инструмента', callback_data='go_back_to_tool_selection')]
-        buttons.append(go_back_button)
-
-        dynamic_keyboard = InlineKeyboardMarkup(buttons)
-
-
         #await update.message.reply_text(text = text_to_show, reply_markup=dynamic_keyboard)
         await context.bot.send_message(chat_id=update.effective_chat.id,
                                        text = text_to_show,
@@ -269,7 +474,7 @@ async def tool_models_show(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def choice_prices_or_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
     callback_data = update.callback_query.data
-    main_logger.debug(f'callback_data in choice_prices_or_details func is: {callback_data}')
+    main_logger.debug('callback_data in choice_prices_or_details func is: %s', callback_data)
 
     if callback_data == 'go_back_to_tool_selection':
         await tool_types_show(update, context) 
@@ -280,7 +485,7 @@ async def choice_prices_or_details(update: Update, context: ContextTypes.DEFAULT
 
     chosen_model = callback_data.replace('__CALLBACK', '')
 
-    context.user_data['chosen_model'] = chosen_model
+    get_session(context.user_data).model_key = chosen_model
 
     text = f'Пожалуйста, выберите действие для инструмента {chosen_model}'
 
@@ -304,7 +509,7 @@ async def choice_prices_or_details(update: Update, context: ContextTypes.DEFAULT
 
 async def show_prices_or_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
     callback_data = update.callback_query.data
-    main_logger.debug(f'callback_data in show_prices_or_details func is: {callback_data}')
+    main_logger.debug('callback_data in show_prices_or_details func is: %s', callback_data)
 
     if callback_data == 'show_chosen_tool_price_list':
         tool_prices_msg = await prices(update, context)
@@ -338,15 +543,18 @@ async def show_prices_or_details(update: Update, context: ContextTypes.DEFAULT_T
         keyboard = InlineKeyboardMarkup(buttons)
 
         if (tool_picture_url) is None or (tool_picture_url == '-'):
-            await context.bot.send_message(chat_id=update.effective_chat.id, text=f'Просим прощения, по инструменту {context.user_data['chosen_tool']} нет спецификаций. Мы работаем над устранением неполадки! Попробуйте указать номер другого инструмента')
-            text = context.bot_data['list_of_tools_text']
-            await context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+            #the apology and the tool list go out as one message
+            async with Outbox(context.bot, update.effective_chat.id) as outbox:
+                outbox.add(f'Просим прощения, по инструменту {get_session(context.user_data).tool} нет спецификаций. Мы работаем над устранением неполадки! Попробуйте указать номер другого инструмента')
+                outbox.add(get_tools_message(context.bot_data, get_session(context.user_data)))
 
             main_logger.debug('returning TOOLS_SELECTION state')
             return TOOLS_SELECTION
         
         else:
-            await context.bot.send_photo(chat_id=update.effective_chat.id, photo=tool_picture_url, caption=tool_details_text, reply_markup=keyboard)
+            #after the first upload telegram gets the photo by its file_id instead of downloading the url again
+            await context.bot_data['photo_cache'].send_photo(context.bot, update.effective_chat.id, get_session(context.user_data).model_key,
+                                                             tool_picture_url, caption=tool_details_text, reply_markup=keyboard)
 
             main_logger.debug('returning SHOW_PRICES_OR_DETAILS state')
             return SHOW_PRICES_OR_DETAILS
@@ -362,7 +570,7 @@ async def show_prices_or_details(update: Update, context: ContextTypes.DEFAULT_T
 
 async def delivery_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
     number_of_days = int(update.message.text)
-    context.user_data['days_to_rent_tool'] = number_of_days
+    get_session(context.user_data).days = number_of_days
 
     buttons = [
         [
@@ -415,13 +623,10 @@ async def delivery_pickup_choice(update: Update, context: ContextTypes.DEFAULT_T
 async def pickup_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     callback_data = update.callback_query.data
     if callback_data == 'confirm_pick_up':
-        context.user_data['delivery_address'] = 'pick_up'
-        await context.bot.send_message(chat_id=update.effective_chat.id,
-                                       text = 'Самовывоз заказа подтвержден')
-        await confirm_order(update, context)
-        
-        main_logger.debug('returning CONCLUDE_ORDER state')
-        return CONCLUDE_ORDER
+        get_session(context.user_data).address = 'pick_up'
+        outbox = Outbox(context.bot, update.effective_chat.id)
+        outbox.add('Самовывоз заказа подтвержден') #sent in one message with the order summary
+        return await confirm_order(update, context, outbox)
     
     elif callback_data == 'delivery_change_mind':
         await delivery_pickup_choice(update, context)
@@ -432,99 +637,156 @@ async def pickup_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def delivery_details_ingestion(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    address_raw = update.message.text
+    address_raw = update.message.text.strip()
 
-    #TODO: INSERT STRING CLEANING AND VALIDATION
+    get_session(context.user_data).address = address_raw
 
-    context.user_data['delivery_address'] = address_raw
+    return await confirm_order(update, context)
+    
 
-    await confirm_order(update, context)
 
-    main_logger.debug('returning CONCLUDE_ORDER state')
-    return CONCLUDE_ORDER
-    
+def render_order_summary(chosen_tool_full, total_price_tool, address, delivery_fee=None, estimate_note=None) -> str:
+    """Order confirmation text.
 
+    With delivery_fee=None the delivery price is shown as still being calculated, with an estimate_note the fee
+    is a local estimate (DeliveryEstimator) and the note tells the user what happens with it.
+    """
+    if address == 'pick_up':
+        return (f'Полная стоимость вашего заказа с учетом самовывоза составляет {total_price_tool} рублей\nПожалуйста, проверьте ваш заказ и адрес доставки:\n\n'
+                f'Выбранный инструмент:\n{chosen_tool_full}\n\n'
+                f'Выбранный адрес доставки:\nСамовывоз по адресу\n')
+
+    if delivery_fee is None:
+        total_line = f'Стоимость аренды составляет {total_price_tool} рублей, рассчитываем стоимость доставки...'
+        delivery_line = 'Стоимость доставки Яндекс Курьером рассчитывается...'
+    elif estimate_note is not None:
+        total_line = f'Ориентировочная стоимость вашего заказа с доставкой составляет {total_price_tool + delivery_fee:.0f} рублей'
+        delivery_line = f'Ориентировочная стоимость доставки Яндекс Курьером ~{delivery_fee:.0f} руб, {estimate_note}'
+    else:
+        total_line = f'Полная стоимость вашего заказа с доставкой составляет {total_price_tool + delivery_fee} рублей'
+        delivery_line = f'Стоимость доставки Яндекс Курьером составляет {delivery_fee} руб'
 
-async def confirm_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    number_days = context.user_data['days_to_rent_tool']
-    tool_pricing = context.user_data['prices_for_chosen_tool']
-    address = context.user_data['delivery_address']
-    
+    return (f'{total_line}\nПожалуйста, проверьте ваш заказ и адрес доставки:\n\n'
+            f'Выбранный инструмент:\n{chosen_tool_full}\n\n'
+            f'Выбранный адрес доставки:\n{address}\n\n{delivery_line}')
 
-    chosen_tool_full = context.user_data['chosen_tool'] + ' ' + context.user_data['chosen_model']
 
-    row_tool = context.user_data['specific_model_row']
-    
+def get_order_keyboard() -> InlineKeyboardMarkup:
+    buttons = [
+        [
+            InlineKeyboardButton(text='Подтвердить заказ', callback_data='confirm_order')
+        ],
+        [
+            InlineKeyboardButton(text="Начать заново", callback_data='restart_order'),
+            InlineKeyboardButton(text="Отменить заказ", callback_data='cancel_order')
+        ]
+    ]
 
-    limits = [1, 3, 7]
-    idx = bisect.bisect_left(limits, number_days)
-    price_per_day = tool_pricing.iloc[idx, 0]
+    return InlineKeyboardMarkup(buttons)
 
-    total_price_tool = int(price_per_day) * int(number_days)    
 
+async def confirm_order(update: Update, context: ContextTypes.DEFAULT_TYPE, outbox: Outbox = None):
+    """outbox: texts the caller still has to send, they are merged into the first message of the confirmation."""
+    started = time.perf_counter()
+    outbox = outbox if outbox is not None else Outbox(context.bot, update.effective_chat.id)
+    session = get_session(context.user_data)
+    number_days = session.days
+    address = session.address
 
+    chosen_tool_full = session.tool + ' ' + session.model_key
 
-    if address != 'pick_up':
-        try:
-            yndx_client = YandexCargoClient(YANDEX_TOKEN)
-            price, _ = await yndx_client.get_prices_for_delivery(from_location=PICK_UP_ADDRESS, to_location=address, item_row=row_tool)
-        except:
-            await context.bot.send_message(chat_id=update.effective_chat.id,
-                                        text = 'Ваш адрес указан в неверном формате или Яндекс Доставка не распознает ваш адрес, попробуйте ввести другой адрес.\n Если вы хотите вернуться к выбору опции получения инструмента, выберите /back_to_delivery_choice из меню команд')
-    else:
-        pass
+    #prices are resolved from the current catalog, the session only keeps the model key
+    record = context.bot_data['catalog'].get_record(session.model_key)
+    if record is None:
+        await outbox.send(f'Просим прощения, инструмент {chosen_tool_full} больше недоступен. Пожалуйста, укажите номер другого инструмента:\n\n' + get_tools_message(context.bot_data, session))
 
+        main_logger.debug('returning TOOLS_SELECTION state')
+        return TOOLS_SELECTION
 
     if address == 'pick_up':
-        delivery_fee = 0
-    else:
-        delivery_fee = price                              #FOR NOW -> PURELY ARBITRARY NUMBER, TODO: ADD THE ACTUAL CALCULATION LATER
+        total_price_tool = calculate_rental_price(record, number_days)
+        await outbox.send(render_order_summary(chosen_tool_full, total_price_tool, address), reply_markup=get_order_keyboard())
 
-    total_price = total_price_tool + delivery_fee
+        main_logger.debug('returning CONCLUDE ORDER')
+        return CONCLUDE_ORDER
 
-    
+    #geocoding starts right away and runs while the rest of the confirmation is prepared
+    yndx_client = context.bot_data['yandex_client']
+    estimator = context.bot_data['delivery_estimator']
+    weight = float(record.weight)
+    geocode_task = asyncio.create_task(yndx_client.geocode_destination(address))
 
-    if address == 'pick_up':
-        address_to_display = 'Самовывоз по адресу'
-        fill_in_text = 'с учетом самовывоза'
-    else:
-        address_to_display = address#'Улица ' + address['street'] + '\nДом ' + address['house_nr'] + '\nКвартира ' + address['apt_nr']
-        fill_in_text = 'с доставкой'
+    total_price_tool = calculate_rental_price(record, number_days)
 
+    try:
+        normalize_address(address) #local format check, a malformed address does not need to wait for yandex
+    except ValueError:
+        geocode_task.cancel()
+        await outbox.send(WRONG_ADDRESS_TEXT)
 
+        main_logger.debug('returning DELIVERY_DETAILS state')
+        return DELIVERY_DETAILS
 
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=f'Полная стоимость вашего заказа {fill_in_text} составляет {total_price} рублей\nПожалуйста, проверьте ваш заказ и адрес доставки:\n\n')
+    placeholder = await outbox.send(render_order_summary(chosen_tool_full, total_price_tool, address))
 
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=f'Выбранный инструмент:\n{chosen_tool_full}\n\n')
+    try:
+        coordinates = await geocode_task
+    except UpstreamError as e:
+        main_logger.debug('Geocoding failed for address %s: %s', address, e)
+        await placeholder.edit_text(text=DELIVERY_UNAVAILABLE_TEXT)
 
+        main_logger.debug('returning DELIVERY_DETAILS state')
+        return DELIVERY_DETAILS
 
-    buttons = [
-        [
-            InlineKeyboardButton(text='Подтвердить заказ', callback_data='confirm_order')
-        ],
-        [
-            InlineKeyboardButton(text="Начать заново", callback_data='restart_order'),
-            InlineKeyboardButton(text="Отменить заказ", callback_data='cancel_order')
-        ]
-    ]
+    if coordinates is None:
+        await placeholder.edit_text(text=WRONG_ADDRESS_TEXT)
 
-    keyboard = InlineKeyboardMarkup(buttons)
+        main_logger.debug('returning DELIVERY_DETAILS state')
+        return DELIVERY_DETAILS
+
+    quote_task = asyncio.create_task(yndx_client.get_prices_for_delivery(from_location=PICK_UP_ADDRESS, to_location=address, weight=weight, coordinates=coordinates))
+    estimate = estimator.estimate(coordinates, weight)
+
+    await asyncio.sleep(0) #a cached quote is ready after one loop iteration, then there is no point in showing the estimate
+    if not quote_task.done():
+        await placeholder.edit_text(text=render_order_summary(chosen_tool_full, total_price_tool, address, estimate, estimate_note='уточняем точную стоимость...'))
+
+    try:
+        quote = await quote_task
+        delivery_fee = quote.price
+        main_logger.debug('Delivery quote %s (estimate %s, cached: %s, age %.0fs)', delivery_fee, estimate, quote.from_cache, quote.age)
+    except UpstreamError as e:
+        if not (e.retryable or isinstance(e, CircuitOpenError)):
+            #yandex answered and refused the address (4xx, outside the delivery zone, no price), an estimate would
+            #let the user confirm a delivery that can not be ordered
+            main_logger.debug('Yandex refused the delivery to %s: %s', address, e)
+            await placeholder.edit_text(text=WRONG_ADDRESS_TEXT)
+
+            main_logger.debug('returning DELIVERY_DETAILS state')
+            return DELIVERY_DETAILS
+
+        #yandex is not answering (or the circuit is open), the order can still go on with the local estimate
+        main_logger.debug('Delivery quote failed for address %s, falling back to the estimate %s: %s', address, estimate, e)
+        await placeholder.edit_text(text=render_order_summary(chosen_tool_full, total_price_tool, address, estimate, estimate_note='точную стоимость доставки подтвердит наш агент'),
+                                    reply_markup=get_order_keyboard())
+
+        main_logger.debug('returning CONCLUDE ORDER')
+        return CONCLUDE_ORDER
 
+    if not quote.from_cache:
+        estimator.observe(coordinates, weight, delivery_fee)
 
-    if address == 'pick_up':
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=f'Выбранный адрес доставки:\n{address_to_display}\n', reply_markup=keyboard)
-    else:
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=f'Выбранный адрес доставки:\n{address_to_display}\n\nСтоимость доставки Яндекс Курьером составляет {delivery_fee} руб', reply_markup=keyboard)
+    await placeholder.edit_text(text=render_order_summary(chosen_tool_full, total_price_tool, address, delivery_fee), reply_markup=get_order_keyboard())
 
-    main_logger.debug('returning CONCLUDE ORDER')
+    main_logger.debug('Order confirmation ready, returning CONCLUDE ORDER', extra={'latency': round(time.perf_counter() - started, 6)})
     return CONCLUDE_ORDER
-    
+
 
 
 
 async def conclude_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
     callback_data = update.callback_query.data
-    main_logger.debug(f'Callback Data in conclude_order func is - {callback_data}')
+    main_logger.debug('Callback Data in conclude_order func is - %s', callback_data)
 
     if callback_data == 'confirm_order':
         # text = 'Ваш заказ подтвержден, спасибо!'
@@ -563,7 +825,7 @@ async def conclude_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return START_PAYMENT
 
     elif callback_data == 'restart_order':
-        list_of_tools_text = context.bot_data['list_of_tools_text']
+        list_of_tools_text = get_tools_message(context.bot_data, get_session(context.user_data))
         await context.bot.send_message(chat_id = update.effective_chat.id,
                                        text=list_of_tools_text)
         
@@ -636,14 +898,88 @@ async def back_to_delivery_question(update: Update, context: ContextTypes.DEFAUL
 MAIN FUNCTION
 """
 
-def main():
+def enable_metrics(application: Application, conv_handler: ConversationHandler, port: int):
+    metrics.enable()
+    metrics.instrument_conversation(conv_handler)
+
+    bot_data = application.bot_data
+    rate_limiter = application.bot.rate_limiter
+    if rate_limiter is not None:
+        metrics.gauge('rentatool_bot_api_queue_depth', 'Bot API requests waiting in the rate limiter', lambda: rate_limiter.stats['waiting'])
+
+    def cache_stats():
+        stats = {}
+        for cache_name, key in (('render', 'render_cache'), ('geocode', 'geocode_cache'), ('photo', 'photo_cache')):
+            cache = bot_data.get(key)
+            if cache is not None:
+                stats.update({(cache_name, event): value for event, value in cache.stats.items()})
+        yandex_client = bot_data.get('yandex_client')
+        if yandex_client is not None:
+            stats.update({('quote', event): value for event, value in yandex_client.quote_stats.items()})
+        return stats
+
+    metrics.gauge('rentatool_cache_events', 'Cache hits, misses and other events since start', cache_stats, ('cache', 'event'))
+    metrics.gauge('rentatool_catalog_sync_events', 'Sheet fetches, unchanged sheets skipped, rebuilds and rows reused or cleaned again',
+                  lambda: {(event,): value for event, value in bot_data['catalog_sync'].stats.items()}, ('event',))
+    metrics.register_collector(bot_data['funnel'].prometheus_lines)
+
+    bot_data['metrics_server'] = metrics.start_http_server(port)
+
+
+def build_application(token=TOKEN, base_url=None, fetch_values=fetch_gsh_values, snapshot_path=CATALOG_SNAPSHOT_FILE,
+                      max_concurrent_updates=MAX_CONCURRENT_UPDATES, persistence_path=PERSISTENCE_FILE,
+                      with_updater=True, sync_catalog=True, metrics_port=METRICS_PORT, request=None, rate_limit=True,
+                      worker_index=None, workers=1) -> Application:
+    """Builds the bot with all its handlers and jobs, without starting it.
+
+    base_url points the bot to another Bot API server (e.g. a local fake one in tests), fetch_values replaces the google sheet.
+    with_updater=False and sync_catalog=False are for the workers of the multi-process mode (see cluster.py): the updates
+    come from the ingress process and the catalog from the snapshot file written by the worker that syncs the sheet.
+    worker_index gives such a worker its own geocode, photo and delivery estimator files (see worker_file), and with
+    workers it loads only the persisted conversations and sessions of the chats the worker serves.
+    request replaces the http layer of the bot requests (e.g. the in-process fake Bot API of benchmarks/load_test.py),
+    rate_limit=False sends them without the TokenBucketRateLimiter.
+    """
     #base setup
     builder = Application.builder()
-    builder.token(TOKEN)
+    builder.token(token)
+    if base_url:
+        builder.base_url(f'{base_url}/bot')
+        builder.base_file_url(f'{base_url}/file/bot')
+    builder.post_init(post_init)
+    builder.post_shutdown(post_shutdown)
+    #every bot request waits for a token of its chat and a global one instead of running into telegram's 429s
+    if rate_limit:
+        builder.rate_limiter(TokenBucketRateLimiter())
+    if request is not None:
+        builder.request(request)
+    if max_concurrent_updates > 1:
+        builder.concurrent_updates(ChatOrderedUpdateProcessor(max_workers=max_concurrent_updates))
+    if persistence_path:
+        shard = (worker_index, workers) if worker_index is not None else None
+        builder.persistence(SQLitePersistence(persistence_path, update_interval=PERSISTENCE_INTERVAL, shard=shard))
+    if not with_updater:
+        builder.updater(None)
     application = builder.build()
+    application.bot_data['worker_index'] = worker_index
 
     #get the GSH data into a dataframe and then add it to the Context object, so that all the handlers have access to it
-    application.job_queue.run_repeating(refresh_gsh, interval=600, first=1)
+    catalog_sync = CatalogSync(fetch_values, snapshot_path=snapshot_path)
+    application.bot_data['catalog_sync'] = catalog_sync
+    application.bot_data['render_cache'] = RenderCache()
+
+    #serve the last known catalog right away, the first refresh reconciles it with the sheet in the background
+    load_started = time.perf_counter()
+    snapshot = catalog_sync.load_local()
+    if snapshot is not None:
+        publish_catalog(application.bot_data, snapshot)
+        main_logger.info('Loaded local catalog snapshot %s in %.1f ms', snapshot.version, (time.perf_counter() - load_started) * 1000)
+
+    if sync_catalog:
+        application.job_queue.run_repeating(refresh_gsh, interval=GSH_REFRESH_INTERVAL, first=0)
+    else:
+        application.job_queue.run_repeating(reload_catalog, interval=CATALOG_RELOAD_INTERVAL, first=0)
+        application.job_queue.run_repeating(share_photos, interval=30, first=5)
 
 
     #conversation handlers
@@ -665,22 +1001,80 @@ def main():
         fallbacks=[CommandHandler('end', end_convo),
                    CommandHandler("start", conversation_start),
                    CommandHandler('back_to_delivery_choice', back_to_delivery_question)
-                  ]
+                  ],
+        name='order_conversation',
+        persistent=bool(persistence_path)
     )
 
     application.bot_data["conv_handler"] = conv_handler
 
+    #the callbacks are wrapped by the funnel (innermost, sees the returned state first), then metrics (times the
+    #funnel's bookkeeping too) and logging (outermost); all three walk the handlers with iter_conversation_handlers
+
+    #current state per chat, funnel counters and time spent per state, fed by the states the callbacks return
+    funnel = FunnelTracker(STATE_NAMES, final_states=(START_PAYMENT,), idle_timeout=FUNNEL_IDLE_TIMEOUT)
+    funnel.instrument_conversation(conv_handler)
+    application.bot_data['funnel'] = funnel
+    application.job_queue.run_repeating(expire_funnel, interval=60, first=60)
+
+    if metrics_port:
+        enable_metrics(application, conv_handler, metrics_port)
+    #last, so that the records logged by the funnel and metrics wrappers carry the chat and state as well
+    logging_setup.instrument_conversation(conv_handler, STATE_NAMES, log=main_logger)
+
     #command handlers
     #application.add_handler(CommandHandler("payment", start_payment))
 
     #adding handlers
     application.add_error_handler(error)
+    application.add_handler(TypeHandler(Update, log_first_update), group=-1)
     application.add_handler(conv_handler)
 
-    application.run_polling() #this line just keeps the bot running until CTRL+C is hit
-
-    
-   
+    return application
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Rent A Tool telegram bot')
+    parser.add_argument('--mode', choices=('polling', 'webhook'), default=os.environ.get('BOT_MODE', 'polling'))
+    parser.add_argument('--listen', default=os.environ.get('WEBHOOK_LISTEN', '0.0.0.0'), help='address the webhook server binds to')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', os.environ.get('WEBHOOK_PORT', 8443))))
+    parser.add_argument('--webhook-url', default=os.environ.get('WEBHOOK_URL'), help='public https base url telegram sends the updates to')
+    parser.add_argument('--webhook-path', default=os.environ.get('WEBHOOK_PATH', 'webhook'))
+    parser.add_argument('--bot-api-url', default=os.environ.get('TELEGRAM_BASE_URL'), help='Bot API server, defaults to https://api.telegram.org')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WORKERS', 1)), help='worker processes, chats are split between them by id')
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    webhook_kwargs = None
+    if args.mode == 'webhook':
+        if not args.webhook_url:
+            raise SystemExit('Webhook mode needs --webhook-url or WEBHOOK_URL')
+
+        #telegram sends the secret back in a header with every update, requests without it are rejected by the server;
+        #the bot registers the webhook itself, so a fresh random secret works as well as a configured one
+        secret_token = os.environ.get('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+        webhook_kwargs = dict(listen=args.listen,
+                              port=args.port,
+                              url_path=args.webhook_path,
+                              webhook_url=f'{args.webhook_url.rstrip("/")}/{args.webhook_path}',
+                              secret_token=secret_token,
+                              allowed_updates=Update.ALL_TYPES)
+
+    if args.workers > 1:
+        from cluster import run_cluster
+        run_cluster(TOKEN, args.workers, mode=args.mode, bot_api_url=args.bot_api_url, webhook_kwargs=webhook_kwargs)
+        return
+
+    application = build_application(base_url=args.bot_api_url)
+    if args.mode == 'webhook':
+        #the server answers 200 as soon as the update is queued, the handlers process it afterwards
+        application.run_webhook(**webhook_kwargs)
+    else:
+        application.run_polling() #this line just keeps the bot running until CTRL+C is hit
 
 
 if __name__ == '__main__':
@@ -0,0 +1,248 @@
+import asyncio
+import bisect
+import functools
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from update_processing import iter_conversation_handlers
+
+
+logger = logging.getLogger(__name__)
+
+#off until enable() is called: track() then hands out a shared no-op and the handlers are not wrapped at all
+ENABLED = False
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock() #the sheet is fetched from a worker thread, the http server reads from its own
+_metrics = []
+_gauges = [] #(name, help, callback returning a number or {label values tuple: number}, label names)
+_collectors = [] #callbacks returning ready lines in the text format
+
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in (*zip(names, values), *extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        _metrics.append(self)
+
+
+    def inc(self, labels=(), amount=1):
+        with _lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with _lock:
+            for labels, value in self._values.items():
+                lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {value}')
+        return lines
+
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {} #labels -> [count per bucket (not cumulative) + one for +Inf, sum, count]
+        _metrics.append(self)
+
+
+    def observe(self, value: float, labels=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with _lock:
+            for labels, (counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += bucket_count
+                    lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, labels, (("le", bound),))} {cumulative}')
+                lines.append(f'{self.name}_sum{_format_labels(self.labelnames, labels)} {total}')
+                lines.append(f'{self.name}_count{_format_labels(self.labelnames, labels)} {count}')
+        return lines
+
+
+
+class _Timer:
+    __slots__ = ('histogram', 'errors', 'labels', 'started')
+
+    def __init__(self, histogram, errors, labels):
+        self.histogram = histogram
+        self.errors = errors
+        self.labels = labels
+
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.started, self.labels)
+        if exc_type is not None and self.errors is not None and not issubclass(exc_type, asyncio.CancelledError):
+            self.errors.inc(self.labels)
+
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.__exit__(exc_type, exc, tb)
+
+
+
+class _NoopTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+
+_NOOP = _NoopTimer()
+
+
+def track(histogram: Histogram, *labels, errors: Counter = None):
+    """Times the with/async with block into histogram (and counts its exceptions in errors) when metrics are enabled."""
+    if not ENABLED:
+        return _NOOP
+    return _Timer(histogram, errors, labels)
+
+
+def gauge(name: str, help: str, callback, labelnames=()):
+    """A value read when the metrics are scraped: callback returns a number, or {label values: number} with labelnames."""
+    _gauges.append((name, help, callback, tuple(labelnames)))
+
+
+#what the bot measures, see track() calls
+HANDLER_SECONDS = Histogram('rentatool_handler_seconds', 'Time spent in a conversation handler callback', ('handler',))
+HANDLER_ERRORS = Counter('rentatool_handler_errors_total', 'Conversation handler callbacks that raised', ('handler',))
+UPSTREAM_SECONDS = Histogram('rentatool_upstream_seconds', 'Latency of calls to external services, retries included', ('upstream', 'operation'))
+UPSTREAM_ERRORS = Counter('rentatool_upstream_errors_total', 'Failed calls to external services', ('upstream', 'operation'))
+BOT_API_SECONDS = Histogram('rentatool_bot_api_seconds', 'Latency of Bot API requests, rate limiter wait excluded', ('method',))
+BOT_API_WAIT_SECONDS = Histogram('rentatool_bot_api_wait_seconds', 'Time Bot API requests waited in the rate limiter', ('method',))
+BOT_API_ERRORS = Counter('rentatool_bot_api_errors_total', 'Failed Bot API requests', ('method',))
+RENDER_SECONDS = Histogram('rentatool_render_seconds', 'Time to render a message on a render cache miss', ('kind',))
+CATALOG_REBUILD_SECONDS = Histogram('rentatool_catalog_rebuild_seconds', 'Time to clean the sheet rows and build a catalog snapshot')
+
+
+def register_collector(callback):
+    """callback() returns a list of lines in the Prometheus text format, HELP and TYPE included."""
+    _collectors.append(callback)
+
+
+def enable():
+    global ENABLED
+    ENABLED = True
+
+
+def instrument_callback(callback, name=None):
+    """Wraps an async handler callback with HANDLER_SECONDS/HANDLER_ERRORS; returns it unchanged when metrics are off."""
+    if not ENABLED:
+        return callback
+
+    name = name or callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context, *args, **kwargs):
+        async with track(HANDLER_SECONDS, name, errors=HANDLER_ERRORS):
+            return await callback(update, context, *args, **kwargs)
+
+    return wrapper
+
+
+def instrument_conversation(conv_handler):
+    """Wraps the callbacks of all the entry points, states and fallbacks of a ConversationHandler."""
+    for _, handler in iter_conversation_handlers(conv_handler):
+        handler.callback = instrument_callback(handler.callback)
+
+
+def render() -> str:
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+
+    for name, help, callback, labelnames in _gauges:
+        lines.extend((f'# HELP {name} {help}', f'# TYPE {name} gauge'))
+        try:
+            value = callback()
+        except Exception as e: #a broken gauge must not break the whole scrape
+            logger.debug('Gauge %s failed: %r', name, e)
+            continue
+        if isinstance(value, dict):
+            lines.extend(f'{name}{_format_labels(labelnames, labels)} {number}' for labels, number in value.items())
+        else:
+            lines.append(f'{name} {value}')
+
+    for callback in _collectors:
+        try:
+            lines.extend(callback())
+        except Exception as e:
+            logger.debug('Collector %r failed: %r', callback, e)
+
+    return '\n'.join(lines) + '\n'
+
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+    """Serves /metrics in the Prometheus text format from a daemon thread, stop it with server.shutdown()."""
+    server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    logger.info('Serving metrics on http://%s:%s/metrics', host, port)
+    return server
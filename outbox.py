@@ -0,0 +1,72 @@
+import logging
+
+from telegram.constants import MessageLimit
+
+
+logger = logging.getLogger(__name__)
+
+SEPARATOR = '\n\n'
+
+
+
+class Outbox:
+    """Collects the texts a handler sends to one chat and sends consecutive ones as a single message.
+
+    Texts are merged while they have the same send options (parse_mode, link previews...), fit into one
+    message and only the last of them has a keyboard. Every message saved this way is one request less
+    against telegram's per chat limit.
+
+        async with Outbox(context.bot, chat_id) as outbox:
+            outbox.add('Самовывоз заказа подтвержден')
+            outbox.add(summary, reply_markup=keyboard) #sent together with the line above on exit
+    """
+
+    def __init__(self, bot, chat_id, max_length=MessageLimit.MAX_TEXT_LENGTH):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.max_length = max_length
+        self._pending = [] #[text, kwargs] of the messages not sent yet, already merged
+
+        self.stats = {'added': 0, 'sent': 0}
+
+
+    def add(self, text: str, **kwargs):
+        self.stats['added'] += 1
+        if self._pending:
+            last_text, last_kwargs = self._pending[-1]
+            merged = last_text + SEPARATOR + text
+            #a keyboard belongs under the last text, so a message with one can not get more text after it
+            if ('reply_markup' not in last_kwargs and {k: v for k, v in kwargs.items() if k != 'reply_markup'} == last_kwargs
+                    and len(merged) <= self.max_length):
+                self._pending[-1] = [merged, kwargs]
+                return
+
+        self._pending.append([text, kwargs])
+
+
+    async def flush(self) -> list:
+        """Sends everything pending, returns the sent Messages."""
+        pending, self._pending = self._pending, []
+        messages = []
+        for text, kwargs in pending:
+            messages.append(await self.bot.send_message(chat_id=self.chat_id, text=text, **kwargs))
+            self.stats['sent'] += 1
+
+        return messages
+
+
+    async def send(self, text: str, **kwargs):
+        """Adds the text and sends it right away together with what is pending, returns the Message that has it."""
+        self.add(text, **kwargs)
+        return (await self.flush())[-1]
+
+
+    async def __aenter__(self):
+        return self
+
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.flush()
+        elif self._pending:
+            logger.debug('Dropping %s unsent messages to %s after %r', len(self._pending), self.chat_id, exc)
@@ -0,0 +1,233 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from cluster import shard_of_chat
+from session import OrderSession
+
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS user_data (
+    user_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS conversations (
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    state TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (name, key)
+);
+'''
+
+
+
+def _encode_value(value):
+    if isinstance(value, OrderSession):
+        return {'__session__': value.to_list()}
+    raise TypeError(f'{type(value).__name__} can not be persisted')
+
+
+def _decode_value(obj: dict):
+    if '__session__' in obj:
+        return OrderSession.from_list(obj['__session__'])
+    return obj
+
+
+def encode_user_data(data: dict) -> str:
+    """user_data as compact json, the OrderSession is stored as a list of its fields."""
+    return json.dumps(data, default=_encode_value, ensure_ascii=False, separators=(',', ':'))
+
+
+def decode_user_data(text: str) -> dict:
+    return json.loads(text, object_hook=_decode_value)
+
+
+
+class SQLitePersistence(BasePersistence):
+    """Stores the conversation states and user_data in a SQLite database in WAL mode.
+
+    Writes are write-behind: the update_* methods called by the application only serialize the entry into
+    the pending batch, a single background task commits the batches in one transaction each from a thread,
+    so handlers and the event loop never wait on the disk. flush() (on shutdown) writes whatever is left.
+
+    bot_data and chat_data are not stored: bot_data only holds runtime objects (clients, caches, the catalog)
+    that have their own files, chat_data is not used. Entries not touched for max_age seconds are dropped on load.
+
+    shard=(index, workers) is for the workers of the multi-process mode sharing one file: only the entries of the
+    chats that worker serves (cluster.shard_of_chat) are loaded, the others are never asked for there.
+    """
+
+    def __init__(self, path: str, update_interval: float = 5, max_age: float = 30 * 24 * 3600, shard=None):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+                         update_interval=update_interval)
+        self.path = path
+        self.max_age = max_age
+        self.shard = shard
+
+        #the default isolation level: `with self._db` is then a real transaction that commits (or rolls back) a whole batch,
+        #in autocommit mode (isolation_level=None) every row would be its own transaction
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL') #in WAL mode a power loss can only lose the last commits, never corrupt the file
+        self._db.executescript(SCHEMA)
+
+        self._pending_users = {} #user_id -> json or None to delete
+        self._pending_conversations = {} #(name, key json) -> state json or None to delete
+        self._writer = None
+
+        self.stats = {'batches': 0, 'rows_written': 0, 'write_time': 0.0, 'errors': 0}
+
+
+    def _in_shard(self, chat_id) -> bool:
+        return self.shard is None or shard_of_chat(chat_id, self.shard[1]) == self.shard[0]
+
+
+    def _prune(self):
+        expired = time.time() - self.max_age
+        with self._db:
+            self._db.execute('DELETE FROM user_data WHERE updated_at < ?', (expired,))
+            self._db.execute('DELETE FROM conversations WHERE updated_at < ?', (expired,))
+
+
+    async def get_user_data(self) -> dict:
+        self._prune()
+        user_data = {}
+        for user_id, data in self._db.execute('SELECT user_id, data FROM user_data'):
+            if not self._in_shard(user_id): #the bot talks in private chats, where the chat id is the user id
+                continue
+            try:
+                user_data[user_id] = decode_user_data(data)
+            except ValueError as e:
+                logger.warning('Skipping unreadable user_data of %s: %s', user_id, e)
+
+        return user_data
+
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+
+    async def get_callback_data(self):
+        return None
+
+
+    async def get_conversations(self, name: str) -> dict:
+        conversations = {}
+        for key, state in self._db.execute('SELECT key, state FROM conversations WHERE name = ?', (name,)):
+            key = tuple(json.loads(key))
+            if self._in_shard(key[0]): #(chat id, user id)
+                conversations[key] = json.loads(state)
+        return conversations
+
+
+    async def update_conversation(self, name: str, key: tuple, new_state) -> None:
+        self._pending_conversations[(name, json.dumps(key))] = None if new_state is None else json.dumps(new_state)
+        self._schedule_write()
+
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        try:
+            self._pending_users[user_id] = encode_user_data(data)
+        except TypeError as e:
+            logger.warning('Not persisting user_data of %s: %s', user_id, e)
+            return
+        self._schedule_write()
+
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._pending_users[user_id] = None
+        self._schedule_write()
+
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+
+    def _schedule_write(self):
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.create_task(self._write_pending())
+
+
+    async def _write_pending(self):
+        #let the rest of the application's update round add to the batch first
+        await asyncio.sleep(0)
+        while self._pending_users or self._pending_conversations:
+            users, self._pending_users = self._pending_users, {}
+            conversations, self._pending_conversations = self._pending_conversations, {}
+            try:
+                await asyncio.to_thread(self._write, users, conversations)
+            except sqlite3.Error as e:
+                self.stats['errors'] += 1
+                logger.error('Could not write %s persistence entries: %s', len(users) + len(conversations), e)
+                #keep them for the next round unless they were updated meanwhile
+                for user_id, data in users.items():
+                    self._pending_users.setdefault(user_id, data)
+                for key, state in conversations.items():
+                    self._pending_conversations.setdefault(key, state)
+                return
+
+
+    def _write(self, users: dict, conversations: dict):
+        started = time.perf_counter()
+        now = time.time()
+        with self._db: #one transaction per batch
+            self._db.executemany('INSERT OR REPLACE INTO user_data VALUES (?, ?, ?)',
+                                 [(user_id, data, now) for user_id, data in users.items() if data is not None])
+            self._db.executemany('DELETE FROM user_data WHERE user_id = ?',
+                                 [(user_id,) for user_id, data in users.items() if data is None])
+            self._db.executemany('INSERT OR REPLACE INTO conversations VALUES (?, ?, ?, ?)',
+                                 [(name, key, state, now) for (name, key), state in conversations.items() if state is not None])
+            self._db.executemany('DELETE FROM conversations WHERE name = ? AND key = ?',
+                                 [key for key, state in conversations.items() if state is None])
+
+        self.stats['batches'] += 1
+        self.stats['rows_written'] += len(users) + len(conversations)
+        self.stats['write_time'] += time.perf_counter() - started
+
+
+    async def flush(self) -> None:
+        if self._writer is not None:
+            await self._writer
+        if self._pending_users or self._pending_conversations:
+            users, self._pending_users = self._pending_users, {}
+            conversations, self._pending_conversations = self._pending_conversations, {}
+            self._write(users, conversations)
+
+        self._db.close()
+        logger.info('Persistence flushed: %s', self.stats)
@@ -0,0 +1,148 @@
+import json
+import logging
+
+from telegram.error import BadRequest, TelegramError
+
+from local_files import save_json
+from rate_limit import PRIORITY_BACKGROUND
+
+
+logger = logging.getLogger(__name__)
+
+
+
+class PhotoCache:
+    """Telegram file_id of every tool photo, so a picture is downloaded from its origin once instead of once per user.
+
+    Entries are keyed by model_index and remember the picture_url they were uploaded from: when the url changes
+    in the sheet the old file_id is simply not used any more (and dropped by prune). With a path the entries
+    are kept in a json file by save()/load(), file_ids of a bot stay valid across restarts.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._entries = {} #model_index -> (picture_url, file_id)
+        self.dirty = False
+
+        self.stats = {'hits': 0, 'uploads': 0, 'stale': 0, 'prewarmed': 0}
+
+
+    def get(self, model_index: str, picture_url: str):
+        entry = self._entries.get(model_index)
+        if entry is not None and entry[0] == picture_url:
+            return entry[1]
+        return None
+
+
+    def put(self, model_index: str, picture_url: str, file_id: str):
+        self._entries[model_index] = (picture_url, file_id)
+        self.dirty = True
+
+
+    def prune(self, catalog):
+        """Drops the entries of models that are gone from the catalog or got another picture."""
+        stale = [model_index for model_index, (picture_url, _) in self._entries.items()
+                 if (record := catalog.get_record(model_index)) is None or record.picture_url != picture_url]
+        for model_index in stale:
+            del self._entries[model_index]
+        if stale:
+            self.dirty = True
+
+
+    async def send_photo(self, bot, chat_id, model_index: str, picture_url: str, **kwargs):
+        file_id = self.get(model_index, picture_url)
+        if file_id is not None:
+            try:
+                message = await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+                self.stats['hits'] += 1
+                return message
+            except BadRequest as e: #the file_id is not valid (any more), upload from the url again
+                logger.warning('Cached photo of %s was rejected (%s), uploading it again', model_index, e)
+                self.stats['stale'] += 1
+                self._entries.pop(model_index, None)
+
+        message = await bot.send_photo(chat_id=chat_id, photo=picture_url, **kwargs)
+        self.stats['uploads'] += 1
+        if message.photo:
+            self.put(model_index, picture_url, message.photo[-1].file_id) #the largest size, the others are thumbnails
+
+        return message
+
+
+    async def prewarm(self, bot, chat_id, catalog):
+        """Uploads the photos of the catalog that are not cached yet to a service chat, at background priority.
+
+        Failed uploads (broken urls) are only logged, the user path will try them again.
+        """
+        background = {'rate_limit_args': {'priority': PRIORITY_BACKGROUND}} if getattr(bot, 'rate_limiter', None) else {}
+        for record in catalog.records.values():
+            url = record.picture_url
+            if not url or url == '-' or self.get(record.model_index, url) is not None:
+                continue
+
+            try:
+                message = await bot.send_photo(chat_id=chat_id, photo=url, disable_notification=True, **background)
+            except BadRequest as e:
+                logger.warning('Could not pre-warm the photo of %s from %s: %s', record.model_index, url, e)
+                continue
+
+            if message.photo:
+                self.put(record.model_index, url, message.photo[-1].file_id)
+                self.stats['prewarmed'] += 1
+            try:
+                await bot.delete_message(chat_id=chat_id, message_id=message.message_id, **background)
+            except TelegramError as e: #the file_id is what matters, a leftover message in the service chat is harmless
+                logger.debug('Could not delete the pre-warm message: %s', e)
+
+
+    def load(self):
+        entries = self.read(self.path)
+        if entries is None:
+            return
+
+        self._entries = {model_index: (picture_url, file_id) for model_index, picture_url, file_id in entries}
+        logger.info('Loaded %s photo file ids from %s', len(self._entries), self.path)
+
+
+    @staticmethod
+    def read(path: str):
+        """Entries of a photo cache file as written by save(), None if there is none (or it can not be read)."""
+        if not path:
+            return None
+
+        try:
+            with open(path, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning('Could not read the photo cache %s: %s', path, e)
+            return None
+
+
+    def merge(self, entries: list):
+        """Adds the file_ids of another process's cache (see read()) for the models this one has no file_id for."""
+        added = 0
+        for model_index, picture_url, file_id in entries:
+            if model_index not in self._entries:
+                self._entries[model_index] = (picture_url, file_id)
+                added += 1
+        if added:
+            self.dirty = True
+        return added
+
+
+    def dump(self) -> list:
+        self.dirty = False
+        return [[model_index, picture_url, file_id] for model_index, (picture_url, file_id) in self._entries.items()]
+
+
+    def save(self, entries: list = None):
+        """Writes the cache to self.path; pass entries taken by dump() to write them from another thread."""
+        if not self.path:
+            return
+
+        if entries is None:
+            entries = self.dump()
+
+        save_json(self.path, entries)
@@ -0,0 +1,184 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+#lower goes first: answers to what the user just did before background sends (photo pre-warming, notifications)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+#telegram's limits: about 30 messages per second overall, 1 per second in a private chat (short bursts are tolerated),
+#20 per minute in a group
+GLOBAL_RATE, GLOBAL_BURST = 30.0, 30
+PRIVATE_CHAT_RATE, PRIVATE_CHAT_BURST = 1.0, 3
+GROUP_CHAT_RATE, GROUP_CHAT_BURST = 20 / 60, 5
+
+
+
+class TokenBucket:
+    """Token bucket whose waiters are served by priority, then in arrival order."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0 #set by a RetryAfter from telegram
+        self._waiters = [] #heap of (priority, sequence, future)
+        self._sequence = itertools.count()
+        self._drainer = None
+
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+
+    def idle(self) -> bool:
+        """Full and nobody waiting, i.e. the bucket can be dropped and recreated later without changing anything."""
+        self._refill(time.monotonic())
+        return not self._waiters and self.tokens >= self.burst and self.paused_until <= self.updated
+
+
+    async def acquire(self, priority: int = PRIORITY_INTERACTIVE) -> bool:
+        """Takes a token, waiting for it if needed; returns whether it had to wait."""
+        now = time.monotonic()
+        self._refill(now)
+        if not self._waiters and self.tokens >= 1 and now >= self.paused_until:
+            self.tokens -= 1
+            return False
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        if self._drainer is None or self._drainer.done():
+            self._drainer = asyncio.create_task(self._drain())
+        await future
+        return True
+
+
+    async def _drain(self):
+        while self._waiters:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                continue
+
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done(): #the sender may have been cancelled meanwhile
+                self.tokens -= 1
+                future.set_result(None)
+
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+
+class TokenBucketRateLimiter(BaseRateLimiter):
+    """Rate limiter for the bot: a global token bucket plus one per chat, with priorities and RetryAfter handling.
+
+    Requests pass the chat bucket first, then the global one, so a chat that is over its limit does not hold
+    global tokens while it waits. rate_limit_args of a bot call may be a dict with 'priority' (PRIORITY_*)
+    and 'max_retries'. On a RetryAfter the sends to the chat (all the sends for requests without a chat) pause
+    for the time telegram asked and the request is retried.
+
+    stats: requests, throttled (had to wait), retries, waiting (queue depth now), max_waiting, send latency
+    (wait + request) count/total/max in seconds.
+    """
+
+    def __init__(self, global_rate=GLOBAL_RATE, global_burst=GLOBAL_BURST, max_retries=2, max_chat_buckets=10000):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.max_retries = max_retries
+        self.max_chat_buckets = max_chat_buckets
+        self._chat_buckets = {}
+
+        self.stats = {'requests': 0, 'throttled': 0, 'retries': 0, 'waiting': 0, 'max_waiting': 0,
+                      'latency_count': 0, 'latency_total': 0.0, 'latency_max': 0.0}
+
+
+    async def initialize(self):
+        pass
+
+
+    async def shutdown(self):
+        pass
+
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= self.max_chat_buckets:
+                self._chat_buckets = {key: bucket for key, bucket in self._chat_buckets.items() if not bucket.idle()}
+            group = not isinstance(chat_id, int) or chat_id < 0 #string ids are channels and supergroups
+            rate, burst = (GROUP_CHAT_RATE, GROUP_CHAT_BURST) if group else (PRIVATE_CHAT_RATE, PRIVATE_CHAT_BURST)
+            bucket = self._chat_buckets[chat_id] = TokenBucket(rate, burst)
+
+        return bucket
+
+
+    async def _acquire(self, bucket, priority):
+        self.stats['waiting'] += 1
+        self.stats['max_waiting'] = max(self.stats['max_waiting'], self.stats['waiting'])
+        try:
+            if await bucket.acquire(priority):
+                self.stats['throttled'] += 1
+        finally:
+            self.stats['waiting'] -= 1
+
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        rate_limit_args = rate_limit_args or {}
+        priority = rate_limit_args.get('priority', PRIORITY_INTERACTIVE)
+        max_retries = rate_limit_args.get('max_retries', self.max_retries)
+
+        chat_id = data.get('chat_id')
+        try:
+            chat_id = int(chat_id) #ids may be passed as strings
+        except (TypeError, ValueError):
+            pass
+        chat_bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+
+        self.stats['requests'] += 1
+        started = time.monotonic()
+        try:
+            for attempt in range(max_retries + 1):
+                with metrics.track(metrics.BOT_API_WAIT_SECONDS, endpoint):
+                    if chat_bucket is not None:
+                        await self._acquire(chat_bucket, priority)
+                    await self._acquire(self.global_bucket, priority)
+
+                try:
+                    with metrics.track(metrics.BOT_API_SECONDS, endpoint, errors=metrics.BOT_API_ERRORS):
+                        return await callback(*args, **kwargs)
+                except RetryAfter as e:
+                    if attempt == max_retries:
+                        raise
+                    retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else float(e.retry_after)
+                    self.stats['retries'] += 1
+                    logger.warning('Telegram asked to wait %.1fs (%s to %s), retrying', retry_after, endpoint, chat_id)
+                    #a flood wait for one chat only holds back that chat, the other users keep getting their answers
+                    (chat_bucket or self.global_bucket).pause(retry_after)
+        finally:
+            latency = time.monotonic() - started
+            self.stats['latency_count'] += 1
+            self.stats['latency_total'] += latency
+            self.stats['latency_max'] = max(self.stats['latency_max'], latency)
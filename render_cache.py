@@ -0,0 +1,36 @@
+import metrics
+
+
+class RenderCache:
+    """Holds the rendered messages and keyboards of the current catalog snapshot.
+
+    Entries are keyed by (kind, tool/model) and are shared by all users. The whole cache is dropped
+    when a snapshot with another version is published, so nothing rendered from an old catalog is served.
+    """
+
+    def __init__(self):
+        self.version = None
+        self._entries = {}
+        self.stats = {'hits': 0, 'misses': 0, 'resets': 0}
+
+
+    def reset(self, version):
+        self.version = version
+        self._entries = {}
+        self.stats['resets'] += 1
+
+
+    def get(self, version, key, build):
+        """Returns the cached value for key, calling build() to render it on the first request for this version."""
+        if version != self.version:
+            self.reset(version)
+
+        try:
+            value = self._entries[key]
+            self.stats['hits'] += 1
+        except KeyError:
+            with metrics.track(metrics.RENDER_SECONDS, key[0]):
+                value = self._entries[key] = build()
+            self.stats['misses'] += 1
+
+        return value
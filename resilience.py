@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import random
+import time
+
+import httpx
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+
+class UpstreamError(Exception):
+    """An external service (yandex cargo, geocoder) did not give a usable answer."""
+
+    def __init__(self, upstream: str, message: str, retryable: bool = True):
+        super().__init__(f'{upstream}: {message}')
+        self.upstream = upstream
+        self.retryable = retryable
+
+
+
+class CircuitOpenError(UpstreamError):
+    def __init__(self, upstream: str, retry_in: float):
+        super().__init__(upstream, f'circuit open, next try in {retry_in:.0f}s')
+
+
+
+class CircuitBreaker:
+    """Fails calls fast for `cooldown` seconds after `failure_threshold` failed calls in a row.
+
+    After the cool-down a single trial call is let through (half-open): its success closes the circuit,
+    its failure opens it again for another cool-down.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, name: str, failure_threshold: int = 5, cooldown: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.stats = {'calls': 0, 'failures': 0, 'rejected': 0, 'opened': 0}
+
+
+    def before_call(self):
+        self.stats['calls'] += 1
+        if self.state == self.CLOSED:
+            return
+
+        retry_in = self.opened_at + self.cooldown - time.monotonic()
+        if self.state == self.OPEN and retry_in <= 0:
+            self.state = self.HALF_OPEN #this call is the trial one
+            return
+
+        self.stats['rejected'] += 1
+        raise CircuitOpenError(self.name, max(retry_in, 0))
+
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+
+
+    def release(self):
+        """The trial call was cancelled without an answer, let the next call try again."""
+        if self.state == self.HALF_OPEN:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic() - self.cooldown
+
+
+    def record_failure(self):
+        self.stats['failures'] += 1
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning('Circuit %s opened after %s failures', self.name, self.failures)
+                self.stats['opened'] += 1
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+
+def is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, (httpx.TransportError, asyncio.TimeoutError)):
+        return True
+    if isinstance(exc, httpx.HTTPStatusError):
+        status = exc.response.status_code
+        return status >= 500 or status == 429
+    return False
+
+
+async def _hedged(call, hedge_after: float):
+    """Runs call(), and a second copy of it if the first one did not answer within hedge_after seconds; the first answer wins."""
+    first = asyncio.ensure_future(call())
+    tasks = {first}
+    #everything after the first task is started is inside the try: when the caller is cancelled (wait_for's deadline)
+    #while waiting, the copies still running are cancelled instead of being left behind
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+        if done:
+            return first.result()
+
+        tasks.add(asyncio.ensure_future(call()))
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+        #both copies failed, report the error of the first one
+        return first.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def call_upstream(name: str, call, breaker: CircuitBreaker = None, deadline: float = 10.0, retries: int = 0,
+                        backoff: float = 0.2, max_backoff: float = 2.0, hedge_after: float = None, operation: str = ''):
+    """Calls the coroutine factory `call` under an overall deadline.
+
+    - retries: extra attempts on timeouts, connection errors, 5xx and 429; only pass it for idempotent calls
+    - backoff: base of the exponential backoff between attempts, with full jitter
+    - hedge_after: start a second, parallel attempt if the first one is slower than this (idempotent calls only)
+    - breaker: fails fast with CircuitOpenError while the upstream is unhealthy
+
+    Any failure is raised as UpstreamError, the original exception is chained. operation only labels the metrics.
+    """
+    async with metrics.track(metrics.UPSTREAM_SECONDS, name, operation, errors=metrics.UPSTREAM_ERRORS):
+        if breaker is not None:
+            breaker.before_call()
+
+        try:
+            return await _call_with_retries(name, call, breaker, deadline, retries, backoff, max_backoff, hedge_after)
+        except asyncio.CancelledError:
+            if breaker is not None:
+                breaker.release()
+            raise
+
+
+async def _call_with_retries(name, call, breaker, deadline, retries, backoff, max_backoff, hedge_after):
+    expires = time.monotonic() + deadline
+    attempt = 0
+    while True:
+        remaining = expires - time.monotonic()
+        try:
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            attempt_call = (lambda: _hedged(call, hedge_after)) if hedge_after else call
+            result = await asyncio.wait_for(attempt_call(), timeout=remaining)
+        except Exception as e:
+            retryable = is_retryable(e)
+            delay = random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+            if retryable and attempt < retries and time.monotonic() + delay < expires:
+                attempt += 1
+                logger.debug('%s attempt %s failed (%r), retrying in %.2fs', name, attempt, e, delay)
+                await asyncio.sleep(delay)
+                continue
+
+            #a 4xx means the request itself is wrong, that says nothing about the health of the upstream
+            if breaker is not None:
+                if retryable:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+            raise UpstreamError(name, repr(e), retryable=retryable) from e
+
+        if breaker is not None:
+            breaker.record_success()
+        return result
@@ -0,0 +1,38 @@
+class OrderSession:
+    """Per-user order state kept in user_data['session'].
+
+    Only keys are stored here, prices, weight and pictures are resolved from the shared catalog on demand,
+    so an open conversation costs a few hundred bytes instead of a DataFrame per user.
+    """
+
+    __slots__ = ('snapshot_version', 'tool', 'model_key', 'days', 'address')
+
+    def __init__(self, snapshot_version=None, tool=None, model_key=None, days=None, address=None):
+        self.snapshot_version = snapshot_version #version of the catalog the user was shown the tool list from
+        self.tool = tool
+        self.model_key = model_key #model_index of the chosen model
+        self.days = days
+        self.address = address #delivery address as typed by the user or 'pick_up'
+
+
+    def __repr__(self):
+        return f'OrderSession(snapshot_version={self.snapshot_version!r}, tool={self.tool!r}, model_key={self.model_key!r}, days={self.days!r}, address={self.address!r})'
+
+
+    def to_list(self) -> list:
+        """Compact form for the persistence, the fields in __slots__ order."""
+        return [getattr(self, name) for name in self.__slots__]
+
+
+    @classmethod
+    def from_list(cls, values: list) -> 'OrderSession':
+        return cls(*values)
+
+
+
+def get_session(user_data: dict) -> OrderSession:
+    session = user_data.get('session')
+    if session is None:
+        session = user_data['session'] = OrderSession()
+
+    return session
@@ -0,0 +1,74 @@
+import asyncio
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+
+def update_chat_key(update):
+    """The chat an update belongs to (the user for updates without a chat, e.g. inline queries), or None."""
+    if isinstance(update, Update):
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        if update.effective_user is not None:
+            return update.effective_user.id
+    return None
+
+
+def iter_conversation_handlers(conv_handler):
+    """(state, handler) for every handler of a ConversationHandler; state is None for the entry points and fallbacks.
+
+    The instrumentation wrappers (metrics, funnel, logging_setup) all go through this, so they wrap the same handlers.
+    """
+    for handler in list(conv_handler.entry_points) + list(conv_handler.fallbacks):
+        yield None, handler
+
+    for state, state_handlers in conv_handler.states.items():
+        for handler in state_handlers:
+            yield state, handler
+
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates of different chats concurrently, updates of the same chat strictly one after another.
+
+    The ConversationHandler state machine relies on seeing the updates of a chat in order, so every chat has its
+    own lock; the locks are FIFO and the update tasks are created in arrival order, so the order is kept.
+    At most max_workers handlers run at the same time. max_pending bounds the updates that are accepted and
+    waiting (the semaphore of the base class), updates waiting for their chat do not take a worker slot.
+    """
+
+    def __init__(self, max_workers: int = 32, max_pending: int = 1024):
+        super().__init__(max_concurrent_updates=max(max_pending, max_workers))
+        self.max_workers = max_workers
+        self._workers = asyncio.BoundedSemaphore(max_workers)
+        self._chat_locks = {} #chat id -> [lock, number of updates holding or waiting for it]
+
+
+    async def do_process_update(self, update, coroutine):
+        key = update_chat_key(update)
+        if key is None: #nothing to keep in order (e.g. updates without chat and user)
+            async with self._workers:
+                await coroutine
+            return
+
+        entry = self._chat_locks.get(key)
+        if entry is None:
+            entry = self._chat_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._workers:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0: #the lock of an idle chat is dropped, so the dict only holds active chats
+                del self._chat_locks[key]
+
+
+    async def initialize(self):
+        pass
+
+
+    async def shutdown(self):
+        pass
@@ -1,97 +1,180 @@
-import httpx
-import asyncio
-import logging
-import pandas as pd
-
-logger = logging.getLogger(__name__)
-from config import YANDEX_TOKEN
-from geo import get_coordinates
-
-from body_templates_api import yandex_delivery_api_templates as templates
-
-
-class YandexCargoClient:
-    def __init__(self, token, base_url="https://b2b.taxi.yandex.net/b2b/cargo/integration/v2/"):
-        self.base_url = base_url
-
-        self.templates = {}
-        self.templates['price_estimation'] = templates.body_estimation.copy()
-
-
-        #self.session = requests.Session()
-        self.headers = {
-            "Authorization": f"Bearer {token}",
-            "Accept-Language": "ru"
-        }
-    
-
-    async def get_tariffs(self, from_location):
-        url = self.base_url + "tariffs"
-        body = {
-            "start_point": [30.3057, 59.9728],
-            "fullname": from_location
-        }
-        async with httpx.AsyncClient() as client:
-            try:
-                response = await client.post(url, headers=self.headers, json=body)
-                response.raise_for_status()
-                return response.json()
-            except httpx.HTTPError as e:
-                logger.exception(e)
-                return None
-        
-    
-
-    async def get_prices_for_delivery(self, item_row, to_location, from_location='Каменоостровский, 61, 1'):
-        url = self.base_url + 'check-price'
-        body = self.templates['price_estimation'].copy()
-
-        to_location_processed = str(to_location).replace(', ',',').strip()
-        to_location_list = str(to_location_processed).split(',')
-
-        coordinates_full_location = 'Санкт-Петербург, ' + to_location_processed
-        coor_2, coor_1 = get_coordinates(coordinates_full_location)
-        coordinates_destination = [coor_1, coor_2]
-
-        #print(coor_2, coor_1)
-
-        ######CHANGE THE TEMPLATE VALUES TO ACTUAL VALUES
-        body['items'][0]['weight'] = float(item_row['detail_weight (kg)'].iloc[0])
-
-        #destination route point ([1])
-        body['route_points'][1]['fullname'] = f'Санкт-Петербург, {to_location_list[0]}, {to_location_list[1]}'
-        body['route_points'][1]['street'] = to_location_list[0]
-        body['route_points'][1]['building'] = to_location_list[1]
-
-        body['route_points'][1]['coordinates'] = coordinates_destination
-
-
-        async with httpx.AsyncClient() as client:
-            try:
-                response = await client.post(url, headers=self.headers, json=body)
-                response.raise_for_status()
-                data = response.json()
-                price = data['price']
-                return float(price), data
-            except httpx.HTTPError as e:
-                print("Response content:", response.text)
-                logger.exception(e)
-                return None
-
-
-
-
-async def main():
-    table = pd.read_csv('TEST_TABLE.csv', sep=',')
-    table['model_index'] = table['Бренд'] + ' ' + table['Модель']
-    row = table.query(f'model_index == "Пульсар ШЭ 150-1800Э"')
-
-    x = YandexCargoClient(YANDEX_TOKEN)
-
-    price, result = await x.get_prices_for_delivery(to_location='Сикейроса, 20, 19', item_row=row)
-    print(result)
-
-
-
-if __name__ == '__main__':
+import httpx
+import asyncio
+import bisect
+import copy
+import logging
+import time
+from typing import NamedTuple
+
+from cachetools import TTLCache
+
+logger = logging.getLogger(__name__)
+from config import YANDEX_TOKEN
+from geo_cache import GeocodeCache
+from resilience import CircuitBreaker, UpstreamError, call_upstream
+
+from body_templates_api import yandex_delivery_api_templates as templates
+
+
+def create_http_client(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60.0,
+                       connect_timeout=3.0, read_timeout=10.0, http2=True) -> httpx.AsyncClient:
+    """Long-lived client with keep-alive pooling, so repeated quotes reuse the TCP/TLS connection to yandex (http2 needs the h2 package)."""
+    limits = httpx.Limits(max_connections=max_connections,
+                          max_keepalive_connections=max_keepalive_connections,
+                          keepalive_expiry=keepalive_expiry)
+    timeout = httpx.Timeout(connect=connect_timeout, read=read_timeout, write=read_timeout, pool=connect_timeout)
+
+    return httpx.AsyncClient(http2=http2, limits=limits, timeout=timeout)
+
+
+
+#quotes are shared between items of the same weight class (kg, upper bounds) going to the same spot
+WEIGHT_BUCKETS = (1, 3, 5, 10, 15, 20, 30, 50, 100)
+#~100 m, finer than what changes a city courier price
+COORDINATES_PRECISION = 3
+
+
+
+class DeliveryQuote(NamedTuple):
+    price: float
+    data: dict #raw check-price response
+    created_at: float #time.monotonic() of the request
+    from_cache: bool = False
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.created_at
+
+
+
+def weight_bucket(weight: float) -> float:
+    idx = bisect.bisect_left(WEIGHT_BUCKETS, weight)
+    return WEIGHT_BUCKETS[idx] if idx < len(WEIGHT_BUCKETS) else float(weight)
+
+
+
+class YandexCargoClient:
+    def __init__(self, token, base_url="https://b2b.taxi.yandex.net/b2b/cargo/integration/v2/", client: httpx.AsyncClient = None,
+                 geocode_cache: GeocodeCache = None, quote_ttl=300, quote_cache_size=5000,
+                 deadline=8.0, retries=2, hedge_after=None, **client_kwargs):
+        self.base_url = base_url
+
+        #check-price and tariffs only read prices, so they are retried (and optionally hedged) under one deadline per call
+        self.call_settings = {'deadline': deadline, 'retries': retries, 'hedge_after': hedge_after}
+        self.breaker = CircuitBreaker('yandex_cargo', failure_threshold=5, cooldown=30.0)
+        self.geocode_cache = geocode_cache if geocode_cache is not None else GeocodeCache()
+        #repeated quotes for the same destination and weight class are answered from here for quote_ttl seconds
+        self.quote_cache = TTLCache(maxsize=quote_cache_size, ttl=quote_ttl)
+        self.quote_stats = {'hits': 0, 'misses': 0}
+
+        self.templates = {}
+        self.templates['price_estimation'] = templates.body_estimation
+
+
+        #one client for the lifetime of the application, see create_http_client for the pool settings
+        self.client = client if client is not None else create_http_client(**client_kwargs)
+        self.headers = {
+            "Authorization": f"Bearer {token}",
+            "Accept-Language": "ru"
+        }
+
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+    async def _post(self, url, body) -> dict:
+        async def request():
+            response = await self.client.post(url, headers=self.headers, json=body)
+            response.raise_for_status()
+            return response.json()
+
+        return await call_upstream('yandex_cargo', request, breaker=self.breaker, operation=url.rsplit('/', 1)[-1], **self.call_settings)
+
+
+    async def get_tariffs(self, from_location):
+        url = self.base_url + "tariffs"
+        body = {
+            "start_point": [30.3057, 59.9728],
+            "fullname": from_location
+        }
+        try:
+            return await self._post(url, body)
+        except UpstreamError as e:
+            logger.warning('Tariffs request failed: %s', e)
+            return None
+        
+    
+
+    async def geocode_destination(self, to_location):
+        """(lat, lon) of a 'street, building, apartment' address in St. Petersburg, None if the geocoder does not know it."""
+        to_location_processed = str(to_location).replace(', ',',').strip()
+        return await self.geocode_cache.get_coordinates(to_location_processed, city='Санкт-Петербург')
+
+
+    async def get_prices_for_delivery(self, weight: float, to_location, from_location='Каменоостровский, 61, 1', coordinates=None):
+        """Returns a DeliveryQuote, raises resilience.UpstreamError if yandex (or the geocoder) fails."""
+        url = self.base_url + 'check-price'
+        body = copy.deepcopy(self.templates['price_estimation']) #the nested route points are filled in below, the template must stay untouched
+
+        to_location_processed = str(to_location).replace(', ',',').strip()
+        to_location_list = str(to_location_processed).split(',')
+
+        #coordinates already geocoded by the caller (lat, lon) can be passed in to skip the lookup
+        if coordinates is None:
+            coordinates = await self.geocode_destination(to_location)
+            if coordinates is None:
+                #an unknown address is an answer, not a failure, asking again would give the same one
+                raise UpstreamError('geocoder', f'unknown address {to_location!r}', retryable=False)
+        coor_2, coor_1 = coordinates
+        coordinates_destination = [coor_1, coor_2]
+
+        quote_key = (from_location, round(coor_1, COORDINATES_PRECISION), round(coor_2, COORDINATES_PRECISION), weight_bucket(weight))
+        quote = self.quote_cache.get(quote_key)
+        if quote is not None:
+            self.quote_stats['hits'] += 1
+            return quote._replace(from_cache=True)
+        self.quote_stats['misses'] += 1
+
+        ######CHANGE THE TEMPLATE VALUES TO ACTUAL VALUES
+        body['items'][0]['weight'] = float(weight)
+
+        #destination route point ([1])
+        body['route_points'][1]['fullname'] = f'Санкт-Петербург, {to_location_list[0]}, {to_location_list[1]}'
+        body['route_points'][1]['street'] = to_location_list[0]
+        body['route_points'][1]['building'] = to_location_list[1]
+
+        body['route_points'][1]['coordinates'] = coordinates_destination
+
+
+        data = await self._post(url, body)
+        try:
+            quote = DeliveryQuote(price=float(data['price']), data=data, created_at=time.monotonic())
+        except (KeyError, TypeError, ValueError):
+            raise UpstreamError('yandex_cargo', f'no price in the check-price response: {data}', retryable=False)
+
+        self.quote_cache[quote_key] = quote
+        return quote
+
+
+
+
+async def main():
+    import pandas as pd
+
+    table = pd.read_csv('TEST_TABLE.csv', sep=',')
+    table['model_index'] = table['Бренд'] + ' ' + table['Модель']
+    row = table.query(f'model_index == "Пульсар ШЭ 150-1800Э"')
+    weight = float(row['detail_weight (kg)'].iloc[0])
+
+    x = YandexCargoClient(YANDEX_TOKEN)
+
+    quote = await x.get_prices_for_delivery(to_location='Сикейроса, 20, 19', weight=weight)
+    logger.info('Quote %s: %s', quote.price, quote.data)
+    await x.aclose()
+
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
     asyncio.run(main())
\ No newline at end of file